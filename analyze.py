@@ -2,13 +2,21 @@
 
 import data as d
 import util as u
+import coding
+import jobs
+import profiling
+import render
+from slicing import SliceIndex
 from analyze_class import classifications
 from contributors import contributors
 from analyze_time import start_times, durations
 from analyze_startstop import start_stop_dates
 
+import numpy as np
 import pandas as pd
 
+import argparse
+import json
 import os
 import shutil
 
@@ -21,21 +29,93 @@ def get_project(wid):
     for proj_name, wids in d.PROJECTS.items():
         if wid in wids: return proj_name
 
-def load():
-  inferring = False #Very much faster -- helpful during development, but I don't trust it for producing real data
-  df = pd.read_csv('all_classifications.csv', parse_dates = d.dates, infer_datetime_format = inferring, dtype = d.dtypes)
-  if not inferring: #inferring reads the dates naively
-    for date in d.dates:
-      if date == 'subj.date': continue
-      df[date] = df[date].dt.tz_convert(None)
-  #At this point, all date/time columns are datetime64[ns, UTC], except for subj.data, which is datetime64[ns]
+#The typed frame from all_classifications.csv is cached here, so that repeat runs do not have to parse the CSV
+#Bump the version whenever parse() changes what it makes of the CSV
+LOAD_CACHE_DIR = 'secrets/load_cache'
+LOAD_CACHE_VERSION = 1
+#Static chart images are cached here (see render.ImageCache), across runs and revisions
+CHART_CACHE_DIR = 'secrets/chart_cache'
+
+#verify_dates is passed to u.parse_timestamps, to check the fast date parsing against the general-purpose parser
+def parse(source, verify_dates = 'off'):
+  df = pd.read_csv(source, dtype = d.dtypes)
+  for date in d.dates:
+    df[date] = u.parse_timestamps(df[date], verify_dates)
+  #At this point, all date/time columns are datetime64[ns], in UTC
+  return df
+
+#Load all_classifications.csv, from the cache if neither the CSV nor the dtypes and dates that it is parsed with have changed
+def load(verify_dates = 'off', cache = True):
+  source = 'all_classifications.csv'
+  if not cache:
+    df = parse(source, verify_dates)
+  else:
+    key = {
+      'version': LOAD_CACHE_VERSION,
+      'format': u.FRAME_FORMAT,
+      'dtypes': {k: str(v) for k, v in d.dtypes.items()},
+      'dates': d.dates,
+    }
+    cached = f'{LOAD_CACHE_DIR}/{u.fnam_norm(source)}'
+    meta = None
+    if os.path.exists(f'{cached}.json'):
+      with open(f'{cached}.json') as f:
+        meta = json.load(f)
+      if meta['key'] != key:
+        meta = None
+    signature = u.file_signature(source, meta and meta['source'])
+    if meta and meta['source']['sha256'] == signature['sha256']:
+      df = u.load_frame(cached)
+    else:
+      df = parse(source, verify_dates)
+      os.makedirs(LOAD_CACHE_DIR, exist_ok = True)
+      u.save_frame(df, cached)
+    if signature != (meta and meta['source']):
+      with open(f'{cached}.json', 'w') as f:
+        json.dump({'key': key, 'source': signature}, f, indent = 2)
+
   if len(df) != len(df.index.unique()): raise Exception("Index is not unique")
   if len(df.classification_id) != len(df.classification_id.unique()): raise Exception("Classification ids are not unique")
   #Uniques are returned in order of appearance, so this should maintain the correct id:name pairing
   d.WORKFLOWS = pd.Series(df.workflow_name.unique(), df.workflow_id.unique())
   return df
 
+#Project for each workflow id, as get_project gives it
+def project_lookup():
+  lookup = {}
+  for proj_name, wids in d.PROJECTS.items():
+    for wid in wids:
+      lookup.setdefault(wid, proj_name)
+  return pd.Series(lookup, dtype = object)
+
 def prepare(class_df):
+  class_df['project'] = class_df.workflow_id.map(project_lookup())
+  if class_df.project.isna().any(): raise Exception(class_df[class_df.project.isna()])
+
+  class_df['workflow_type'] = class_df.workflow_id.map(pd.Series(d.workflow_map, dtype = object))
+  if class_df.workflow_type.isna().any(): raise KeyError(class_df.workflow_id[class_df.workflow_type.isna()].unique())
+
+  class_df['duration'] = class_df['md.finished_at'].subtract(class_df['md.started_at'])
+
+  utc_offset = pd.to_timedelta(class_df['md.utc_offset'], unit = 'seconds')
+  class_df['local.started_at'] = class_df['md.started_at'] - utc_offset
+  class_df['local.finished_at'] = class_df['md.finished_at'] - utc_offset
+
+  #At this stage, we have just added columns to the original dataframe. No data has been lost.
+  #The drops below return new frames, so this does not need to be a copy.
+  pre_discards = class_df
+
+  #Data to discard
+  negative_df = class_df[class_df.duration < pd.Timedelta(0)].copy()
+  class_df = class_df.drop(negative_df.index)
+
+  anon_df = class_df[class_df.pseudonym.str.startswith('a')].copy()
+  class_df = class_df.drop(anon_df.index)
+
+  return _subsets(class_df, pre_discards, negative_df, anon_df)
+
+#The original, row-at-a-time, version of prepare. Kept to check prepare against with --verify-prepare.
+def prepare_rowwise(class_df):
   class_df['project'] = class_df.workflow_id.apply(get_project)
   if class_df.project.isna().any(): raise Exception(class_df[class_df.project.isna()])
 
@@ -57,6 +137,9 @@ def prepare(class_df):
   anon_df = class_df[class_df.pseudonym.apply(lambda x: x[0] == 'a')].copy()
   class_df = class_df.drop(anon_df.index)
 
+  return _subsets(class_df, pre_discards, negative_df, anon_df)
+
+def _subsets(class_df, pre_discards, negative_df, anon_df):
   #Useful subsets of the kept data
   p_counts = class_df.pseudonym.value_counts()
 
@@ -79,23 +162,93 @@ def prepare(class_df):
     ('Anonymous', anon_df, ['pseudonym'], 'May not be an individual; hashes can change, resulting in inconsistent identification across workflows/projects')
   )
 
+#Raise an exception if two results of prepare differ in any way
+def compare_prepared(expected, actual):
+  (e_df, e_subsets, e_pre, *e_deletions), (a_df, a_subsets, a_pre, *a_deletions) = expected, actual
+  pd.testing.assert_frame_equal(e_df, a_df, check_exact = True)
+  pd.testing.assert_frame_equal(e_pre, a_pre, check_exact = True)
+  assert e_subsets.keys() == a_subsets.keys()
+  for k in e_subsets:
+    pd.testing.assert_index_equal(e_subsets[k], a_subsets[k], exact = True)
+  assert len(e_deletions) == len(a_deletions)
+  for (e_label, e_del_df, e_cols, e_why), (a_label, a_del_df, a_cols, a_why) in zip(e_deletions, a_deletions):
+    assert (e_label, e_cols, e_why) == (a_label, a_cols, a_why)
+    pd.testing.assert_frame_equal(e_del_df, a_del_df, check_exact = True)
+
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--verify-dates',
+                      choices = ['full', 'sample', 'off'],
+                      default = 'sample',
+                      help = 'Check the parsed dates against the (much slower) general-purpose date parser for every value, for a sample of values from each column, or not at all')
+  parser.add_argument('--load-cache',
+                      action = argparse.BooleanOptionalAction,
+                      default = True,
+                      help = f'Cache the parsed all_classifications.csv in {LOAD_CACHE_DIR}')
+  parser.add_argument('--chart-cache',
+                      action = argparse.BooleanOptionalAction,
+                      default = True,
+                      help = f'Reuse static chart images from {CHART_CACHE_DIR} when a chart comes out the same as in an earlier run, rather than drawing them again')
+  parser.add_argument('--verify-prepare',
+                      action = argparse.BooleanOptionalAction,
+                      default = False,
+                      help = 'Check the prepared data against the original (slow, row-at-a-time) preparation code')
+  parser.add_argument('--coded',
+                      action = argparse.BooleanOptionalAction,
+                      default = False,
+                      help = f'Give the analyses integer codes in place of the strings in the {", ".join(coding.COLUMNS)} columns. Outputs should be identical to those without this option.')
+  parser.add_argument('--jobs', '-j',
+                      type = int,
+                      default = 1,
+                      help = 'Number of charts (or other analysis jobs) to work on at once, each in its own process')
+  parser.add_argument('--renderers',
+                      type = int,
+                      help = 'Number of processes writing the static (svg and png) images of the charts (default: as many as --jobs, up to the number of cores)')
+  parser.add_argument('--profile',
+                      choices = ['off', 'stages', 'cprofile'],
+                      nargs = '?',
+                      const = 'stages',
+                      default = 'off',
+                      help = 'Record wall time, CPU time, peak memory and throughput of each stage (loading, preparation, each analysis, chart job and chart image) in profile.json, beside log.txt. --profile on its own is --profile=stages. With cprofile, also dump cProfile stats for each stage in profile_cprofile/.')
+  parser.add_argument('--seed',
+                      type = int,
+                      help = 'Seed the random number generator, so that the randomly sampled outputs are reproducible (e.g. for comparing runs with check_csv_dumps.sh)')
+  args = parser.parse_args()
+  if args.seed is not None:
+    np.random.seed(args.seed)
+
   SAMPLE = 10
-  d.HEAD = u.git_HEAD()
+  run = u.start_run(d, args)
+  d.HEAD = run.head
   if os.path.isdir(f'./secrets/graphs/{d.HEAD}/'):
     shutil.rmtree(f'./secrets/graphs/{d.HEAD}/')
   os.makedirs(f'./secrets/graphs/{d.HEAD}')
+  run.write(f'./secrets/graphs/{d.HEAD}/manifest.json')
+  profiling.start(args.profile, f'./secrets/graphs/{d.HEAD}/profile.json')
 
   u.Logger(f'./secrets/graphs/{d.HEAD}/log.txt')
 
   print('Loading data')
-  original_df = load()
+  with profiling.stage('load') as s:
+    original_df = load(args.verify_dates, args.load_cache)
+    s.rows = len(original_df)
+  original_full_size = len(original_df)
   print('Preparing data')
-  class_df, subsets, undeleted_df, *deletions = prepare(original_df.copy())
-  class_df.to_csv(f'secrets/graphs/{d.HEAD}/prepared_classifications.csv')
+  if args.verify_prepare:
+    with profiling.stage('prepare_rowwise', rows = original_full_size):
+      expected = prepare_rowwise(original_df.copy())
+  #We have no further use for the unprepared data, so let prepare work on it in place rather than on a copy
+  with profiling.stage('prepare', rows = original_full_size):
+    class_df, subsets, undeleted_df, *deletions = prepare(original_df)
+  del original_df
+  if args.verify_prepare:
+    print('Checking prepared data against row-wise preparation')
+    compare_prepared(expected, (class_df, subsets, undeleted_df, *deletions))
+    del expected
+  with profiling.stage('prepared_classifications.csv', rows = len(class_df)):
+    class_df.to_csv(f'secrets/graphs/{d.HEAD}/prepared_classifications.csv')
 
   full_size = len(class_df)
-  original_full_size = len(original_df)
 
   print('Discards')
   print('-' * len('discards'))
@@ -131,8 +284,26 @@ if __name__ == '__main__':
     print(f'{k + ":":10}{c:7,} classifications ({c / full_size:06.2%} of {full_size} undiscarded classifications.)')
   print('\n\n')
 
-  classifications(class_df.copy(), subsets)
-  contributors(class_df.copy(), subsets)
-  durations(class_df.copy(), subsets)
-  start_times(class_df.copy(), subsets)
-  start_stop_dates(class_df.copy(), subsets)
+  #From here on, we only need the undiscarded data
+  del undeleted_df, deletions
+  if args.coded:
+    class_df = coding.encode(class_df)
+
+  #All of the analyses share the one frame, rather than each having a copy. So they must not change it: any derived
+  #columns go in their own projections of it.
+  #Each analysis submits its charts (or, for those without charts, itself) as jobs to the pool, which works on up to
+  #args.jobs of them at once. The analyses do not have to wait for one another.
+  #The charts' static images are queued for the renderer processes, which we wait for once all of the jobs are done.
+  fingerprint = u.frame_fingerprint(class_df)
+  slices = SliceIndex(class_df)
+  if args.chart_cache:
+    render.CACHE = render.ImageCache(CHART_CACHE_DIR, volatile = [run.condition])
+  with profiling.stage('analyses', rows = len(class_df)), render.Renderer(args.renderers or min(os.cpu_count() or 1, args.jobs)):
+    with jobs.Pool(args.jobs, args.seed) as pool:
+      for analysis in classifications, contributors, durations, start_times, start_stop_dates:
+        with profiling.stage(analysis.__name__, rows = len(class_df)):
+          analysis(class_df, slices, subsets, pool)
+        u.check_unchanged(class_df, fingerprint, analysis.__name__)
+    print('Waiting for chart images to be written')
+  if render.CACHE:
+    print(render.CACHE.report())
@@ -1,9 +1,9 @@
 import data as d
 import util as u
+import render
 import pandas as pd
 import plotly.express as px
 import os
-from multiprocessing import Process
 
 def drawit(label, df, filepath, filename):
   cpv = df.pseudonym.value_counts(normalize = True).reset_index(drop = True) #% of total classifications per volunteer
@@ -43,16 +43,13 @@ def drawit(label, df, filepath, filename):
 
 
   fig = px.bar(cpv, title = f'{label}<br>% of total classifications by each {bin_size} volunteers, from most to least prolific<br>({len(df)} total classifications by {v_c} total volunteers)', range_y = [0, 100])
-  fig.write_image(filepath + '/static/' + filename + '_class_vol.svg', width = 1600, height = 1200)
-  fig.write_image(filepath + '/static/' + filename + '_class_vol.png', width = 1600, height = 1200)
+  render.write_images(fig, [filepath + '/static/' + filename + '_class_vol.svg', filepath + '/static/' + filename + '_class_vol.png'], width = 1600, height = 1200)
   fig.write_html(filepath + '/dynamic/' + filename + '_class_vol.html', include_plotlyjs = 'directory')
   cpv.to_csv  (filepath + '/' + filename + '_class_vol.csv', mode = 'x')
 
 
 
-def classifications(df, subsets):
-  SINGLE = True
-
+def classifications(df, slices, subsets, pool):
   print('Computing volunteers per classification count')
 
   proj_path = u.path_norm(f'secrets/graphs/{d.HEAD}/class_counts/project/')
@@ -63,35 +60,17 @@ def classifications(df, subsets):
     os.makedirs(flow_path + '/' + x)
     os.makedirs(type_path + '/' + x)
 
-  procs = []
   #By project
   for project, wids in d.PROJECTS.items():
     print(f'  ... for project {project!r}')
-    if SINGLE:
-      drawit                              (f'All workflows in project <b>{project!r}   {[u.git_condition()]}</b>', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project))
-    else:
-      p = Process(target = drawit, args = (f'All workflows in project <b>{project!r}   {[u.git_condition()]}</b>', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project)))
-      p.start()
-      procs.append(p)
+    pool.submit(drawit, f'All workflows in project <b>{project!r}   {[u.RUN.condition]}</b>', slices.project(project), proj_path, u.fnam_norm(project))
 
   #By workflow
   for workflow, wid in list(zip(d.WORKFLOWS, d.WORKFLOWS.index)):
     print(f'  ... for workflow {workflow!r} ({d.LABELS[wid]})')
-    if SINGLE:
-      drawit                              (f'Workflow <b>{d.LABELS[wid]}</b>   [{u.git_condition()}]', df[df.workflow_id == wid], flow_path, u.fnam_norm(workflow))
-    else:
-      p = Process(target = drawit, args = (f'Workflow <b>{d.LABELS[wid]}</b>   [{u.git_condition()}]', df[df.workflow_id == wid], flow_path, u.fnam_norm(workflow)))
-      p.start()
-      procs.append(p)
+    pool.submit(drawit, f'Workflow <b>{d.LABELS[wid]}</b>   [{u.RUN.condition}]', slices.workflow(wid), flow_path, u.fnam_norm(workflow))
 
   #By workflow type
   for w_type, wids in d.WORKFLOW_TYPES_BACKMAP.items():
     print(f'  ... for workflow type {w_type!r}')
-    if SINGLE:
-      drawit                              (f'All workflows of type <b>{w_type}</b>   [{u.git_condition()}]<br>UTC dates', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type))
-    else:
-      p = Process(target = drawit, args = (f'All workflows of type <b>{w_type}</b>   [{u.git_condition()}]<br>UTC dates', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type)))
-      p.start()
-      procs.append(p)
-  if not SINGLE:
-    for p in procs: p.join()
+    pool.submit(drawit, f'All workflows of type <b>{w_type}</b>   [{u.RUN.condition}]<br>UTC dates', slices.workflow_type(w_type), type_path, u.fnam_norm(w_type))
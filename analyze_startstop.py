@@ -1,9 +1,11 @@
 import data as d
 import util as u
+import render
 import pandas as pd
 import plotly.express as px
 import os
-from multiprocessing import Process
+import plotly.graph_objects as go
+import string
 
 #Re https://plotly.com/python/marker-style/
 #Or import plotly;print(plotly.validators.scatter.marker.SymbolValidator().values)
@@ -18,14 +20,12 @@ def drawit(label, df, filepath, filename):
   last_time = last_time.value_counts()
 
   fig = px.bar(first_time, title = f'{label}<br>Number of volunteers making first classification on date')
-  fig.write_image(filepath + '/static/' + filename + '_firstday.svg', width = 1600, height = 1200)
-  fig.write_image(filepath + '/static/' + filename + '_firstday.png', width = 1600, height = 1200)
+  render.write_images(fig, [filepath + '/static/' + filename + '_firstday.svg', filepath + '/static/' + filename + '_firstday.png'], width = 1600, height = 1200)
   fig.write_html(filepath + '/dynamic/' + filename + '_firstday.html', include_plotlyjs = 'directory')
   first_time.to_csv(filepath + '/' + filename + '_first_time.csv', mode = 'x')
 
   fig = px.bar(last_time, title = f'{label}<br>Number of volunteers making final classification on date')
-  fig.write_image(filepath + '/static/' + filename + '_lastday.svg', width = 1600, height = 1200)
-  fig.write_image(filepath + '/static/' + filename + '_lastday.png', width = 1600, height = 1200)
+  render.write_images(fig, [filepath + '/static/' + filename + '_lastday.svg', filepath + '/static/' + filename + '_lastday.png'], width = 1600, height = 1200)
   fig.write_html(filepath + '/dynamic/' + filename + '_lastday.html', include_plotlyjs = 'directory')
   last_time.to_csv(filepath + '/' + filename + '_last_time.csv', mode = 'x')
 
@@ -44,17 +44,50 @@ def drawit(label, df, filepath, filename):
   gain = first_time.subtract(last_time, fill_value = 0)
   fig = fig.add_bar(x = gain.index, y = gain.values, name = 'Gain')
 
-  fig.write_image(filepath + '/static/' + filename + '_gain.svg', width = 1600, height = 1200)
-  fig.write_image(filepath + '/static/' + filename + '_gain.png', width = 1600, height = 1200)
+  render.write_images(fig, [filepath + '/static/' + filename + '_gain.svg', filepath + '/static/' + filename + '_gain.png'], width = 1600, height = 1200)
   fig.write_html(filepath + '/dynamic/' + filename + '_gain.html', include_plotlyjs = 'directory')
   active.to_csv(filepath + '/' + filename + '_active.csv', mode = 'x')
   gain.to_csv  (filepath + '/' + filename + '_gain.csv', mode = 'x')
 
   return active
 
-def start_stop_dates(df, subsets):
-  SINGLE = True
+#Charts of active volunteers on each of the workflows in wids, from their actives series (as returned by drawit)
+def draw_aggregate(title, actives, wids, filepath, filename, variations = False):
+  fig = go.Figure(layout = { 'colorway': px.colors.qualitative.Dark24, #re https://plotly.com/python/discrete-color/
+                             'template': 'simple_white',
+  })
+  fig.update_layout(title = title)
+  for wid in wids:
+    fig.add_trace(go.Scatter(x = actives[wid].index, y = actives[wid].values, name = d.LABELS[wid]))
+
+  if variations: #Special case for HMS, as this one is cluttered
+    #Line-only
+    fig.update_traces(line_width = 4)
+    render.write_images(fig, [filepath + '/static/' + filename + '_agg_gain_line.png'], width = 1600, height = 1200)
+    fig.write_html(filepath + '/dynamic/' + filename + '_agg_gain_line.html')
+
+    #Letter-only (experimental)
+    letters = (x for x in string.ascii_uppercase)
+    fig.for_each_trace(lambda x: x.update(mode = 'text', text=next(letters)))
+    fig.update_traces(textfont_size = 8)
+    render.write_images(fig, [filepath + '/static/' + filename + '_agg_gain_letters.png'], width = 1600, height = 1200)
+    fig.write_html(filepath + '/dynamic/' + filename + '_agg_gain_letters.html')
+
+    #Big symbols on this one will just smoosh together, lines make it even more cluttered
+    fig.update_traces(mode =       'markers', marker_size = 6)
+  else:
+    fig.update_traces(mode = 'lines+markers', marker_size = 8, line_width = 1, line_dash = 'dot')
+
+  #Put the symbols in
+  symbols = SYMBOLS()
+  fig.for_each_trace(lambda x: x.update(marker_symbol = next(symbols)))
+  render.write_images(fig, [filepath + '/static/' + filename + '_agg_gain.png'], width = 1600, height = 1200)
+  fig.write_html(filepath + '/dynamic/' + filename + '_agg_gain.html', include_plotlyjs = 'directory')
 
+  #Data is the same for all of the above figure variations
+  pd.Series().append([actives[x] for x in wids]).to_csv(filepath + '/' + filename + '_agg_gain.csv', mode = 'x')
+
+def start_stop_dates(df, slices, subsets, pool):
   print('Computing first and last classification dates')
 
   proj_path = u.path_norm(f'secrets/graphs/{d.HEAD}/class_times/project/first_last_day/')
@@ -65,57 +98,21 @@ def start_stop_dates(df, subsets):
     os.makedirs(flow_path + '/' + x)
     os.makedirs(type_path + '/' + x)
 
-  procs = []
   #By project
   for project, wids in d.PROJECTS.items():
     print(f'  ... for project {project!r}')
-    if SINGLE:
-      drawit                              (f'All workflows in project <b>{project!r}   {[u.git_condition()]}</b><br>UTC dates', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project))
-    else:
-      p = Process(target = drawit, args = (f'All workflows in project <b>{project!r}   {[u.git_condition()]}</b><br>UTC dates', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project)))
-      p.start()
-      procs.append(p)
+    pool.submit(drawit, f'All workflows in project <b>{project!r}   {[u.RUN.condition]}</b><br>UTC dates', slices.project(project), proj_path, u.fnam_norm(project))
 
   #By workflow
   actives = {}
   for workflow, wid in list(zip(d.WORKFLOWS, d.WORKFLOWS.index)):
     print(f'  ... for workflow {workflow!r} ({d.LABELS[wid]})')
     if wid in actives: raise Exception()
-    actives[wid] = drawit(f'Workflow <b>{d.LABELS[wid]}</b>   [{u.git_condition()}]<br>UTC dates', df[df.workflow_id == wid], flow_path, u.fnam_norm(workflow))
+    actives[wid] = pool.submit(drawit, f'Workflow <b>{d.LABELS[wid]}</b>   [{u.RUN.condition}]<br>UTC dates', slices.workflow(wid), flow_path, u.fnam_norm(workflow))
+  actives = {wid: task.result() for wid, task in actives.items()}
 
   for project, wids in d.PROJECTS.items():
-    import plotly.graph_objects as go
-    fig = go.Figure(layout = { 'colorway': px.colors.qualitative.Dark24, #re https://plotly.com/python/discrete-color/
-                               'template': 'simple_white',
-    })
-    fig.update_layout(title = f'Active volunteers on {project} {[u.git_condition()]}')
-    for wid in wids:
-      fig.add_trace(go.Scatter(x = actives[wid].index, y = actives[wid].values, name = d.LABELS[wid]))
-
-    if project == d.HMS: #Special case, as this one is cluttered
-      #Line-only
-      fig.update_traces(line_width = 4)
-      fig.write_image(proj_path + '/static/' + u.fnam_norm(project) + '_agg_gain_line.png', width = 1600, height = 1200)
-      fig.write_html(proj_path + '/dynamic/' + u.fnam_norm(project) + '_agg_gain_line.html')
-
-      #Letter-only (experimental)
-      import string
-      letters = (x for x in string.ascii_uppercase)
-      fig.for_each_trace(lambda x: x.update(mode = 'text', text=next(letters)))
-      fig.update_traces(textfont_size = 8)
-      fig.write_image(proj_path + '/static/' + u.fnam_norm(project) + '_agg_gain_letters.png', width = 1600, height = 1200)
-      fig.write_html(proj_path + '/dynamic/' + u.fnam_norm(project) + '_agg_gain_letters.html')
-
-    #Alter the figure to work nicely with symbols, and put the symbols in
-    if project == d.HMS: fig.update_traces(mode =       'markers', marker_size = 6) #Big symbols on this one will just smoosh together, lines make it even more cluttered
-    else:                fig.update_traces(mode = 'lines+markers', marker_size = 8, line_width = 1, line_dash = 'dot')
-    symbols = SYMBOLS()
-    fig.for_each_trace(lambda x: x.update(marker_symbol = next(symbols)))
-    fig.write_image(proj_path + '/static/' + u.fnam_norm(project) + '_agg_gain.png', width = 1600, height = 1200)
-    fig.write_html(proj_path + '/dynamic/' + u.fnam_norm(project) + '_agg_gain.html', include_plotlyjs = 'directory')
-
-    #Data is the same for all of the above figure variations
-    pd.Series().append([actives[x] for x in wids]).to_csv(proj_path + '/' + u.fnam_norm(project) + '_agg_gain.csv', mode = 'x')
+    pool.submit(draw_aggregate, f'Active volunteers on {project} {[u.RUN.condition]}', actives, wids, proj_path, u.fnam_norm(project), variations = project == d.HMS)
 
   special_workflow_map = {
     'Numbers': [18611, 18616, 18619, 18625],
@@ -125,27 +122,9 @@ def start_stop_dates(df, subsets):
   }
 
   for w_type, t_wids in special_workflow_map.items():
-    fig = go.Figure(layout = { 'colorway': px.colors.qualitative.Dark24, #re https://plotly.com/python/discrete-color/
-                               'template': 'simple_white'
-    })
-    fig.update_layout(title = f'Active volunteers on HMS NHS ({w_type}) {[u.git_condition()]}')
-    for t_wid in t_wids:
-      fig.add_trace(go.Scatter(x = actives[t_wid].index, y = actives[t_wid].values, name = d.LABELS[t_wid]))
-    fig.update_traces(mode = 'lines+markers', marker_size = 8, line_width = 1, line_dash = 'dot')
-    symbols = SYMBOLS()
-    fig.for_each_trace(lambda x: x.update(marker_symbol = next(symbols)))
-    fig.write_image(type_path + '/static/' + u.fnam_norm(w_type) + '_agg_gain.png', width = 1600, height = 1200)
-    fig.write_html(type_path + '/dynamic/' + u.fnam_norm(w_type) + '_agg_gain.html', include_plotlyjs = 'directory')
-    pd.Series().append([actives[x] for x in t_wids]).to_csv(type_path + '/' + u.fnam_norm(w_type) + '_agg_gain.csv', mode = 'x')
+    pool.submit(draw_aggregate, f'Active volunteers on HMS NHS ({w_type}) {[u.RUN.condition]}', actives, t_wids, type_path, u.fnam_norm(w_type))
 
   #By workflow type
   for w_type, wids in d.WORKFLOW_TYPES_BACKMAP.items():
     print(f'  ... for workflow type {w_type!r}')
-    if SINGLE:
-      drawit                              (f'All workflows of type <b>{w_type}</b>   [{u.git_condition()}]<br>UTC dates', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type))
-    else:
-      p = Process(target = drawit, args = (f'All workflows of type <b>{w_type}</b>   [{u.git_condition()}]<br>UTC dates', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type)))
-      p.start()
-      procs.append(p)
-  if not SINGLE:
-    for p in procs: p.join()
+    pool.submit(drawit, f'All workflows of type <b>{w_type}</b>   [{u.RUN.condition}]<br>UTC dates', slices.workflow_type(w_type), type_path, u.fnam_norm(w_type))
@@ -1,23 +1,28 @@
 import data as d
 import util as u
+import render
+import coding
 
 import pandas as pd
 import plotly.io as pio
 import plotly.express as px
 
 import os
-from multiprocessing import Process
 
-def durations(durations_df, subsets):
-  durations_df.duration = durations_df.duration.dt.total_seconds().div(60)
+def durations(df, slices, subsets, pool):
+  pool.submit(draw_durations, df, slices)
+
+def draw_durations(durations_df, slices):
+  #durations_df is shared with the other analyses, so work on a local copy. The whole thing is output, including the
+  #workflow names on the chart, so this is also where it is decoded.
+  durations_df = coding.decode(durations_df.assign(duration = durations_df.duration.dt.total_seconds().div(60)))
   filepath = f'secrets/graphs/{d.HEAD}/class_times/workflow/duration_stats'
   for x in 'static', 'dynamic': os.makedirs(filepath + '/' + x)
   fig = px.box(durations_df, x = 'workflow_name', y = 'duration',
                points = 'suspectedoutliers', notched = True,
                labels = { 'workflow_name': 'Workflow Name', 'duration': 'Minutes'})
   fig.update_traces(quartilemethod = 'linear')
-  fig.write_image(filepath + '/static/all_times_box.svg', width = 1600, height = 1200)
-  fig.write_image(filepath + '/static/all_times_box.png', width = 1600, height = 1200)
+  render.write_images(fig, [filepath + '/static/all_times_box.svg', filepath + '/static/all_times_box.png'], width = 1600, height = 1200)
   fig.write_html(filepath + '/dynamic/all_times_box.html', include_plotlyjs = 'directory')
   durations_df.to_csv(filepath + '/all_times_box.csv', mode = 'x')
   print('\nStatistical overview of workflow durations')
@@ -25,13 +30,11 @@ def durations(durations_df, subsets):
   for project, wids in d.PROJECTS.items():
     print('\n' + project); print('-' * len(project))
     print(pd.DataFrame(
-      { d.LABELS[wid]: durations_df[durations_df.workflow_id == wid]['duration'] for wid in wids }
+      { d.LABELS[wid]: slices.workflow(wid, durations_df)['duration'] for wid in wids }
     ).describe())
 
 
-def start_times(start_df, subsets):
-  SINGLE = True
-
+def start_times(start_df, slices, subsets, pool):
   print('Computing all times started (local time)')
 
   def convert_period(x):
@@ -59,15 +62,24 @@ def start_times(start_df, subsets):
   DAYS = ['Mon', 'Tues', 'Weds', 'Thurs', 'Fri', 'Sat', 'Sun']
   PERIODS = ['Small hours', 'Early morning', 'Morning', 'Afternoon', 'Evening', 'Night']
 
-  start_df['period'] = start_df['local.started_at'].apply(convert_period)
-  start_df['day'] = start_df['local.started_at'].apply(convert_day)
-  start_df = start_df[['project', 'pseudonym', 'workflow_id', 'workflow_name', 'day', 'period']].sort_values(['day', 'period'])
-  start_df.day = start_df.day.map(dict(enumerate(DAYS))) #Re https://stackoverflow.com/a/48472623
-  start_df.period = start_df.period.map(dict(enumerate(PERIODS)))
+  #start_df is shared with the other analyses, so add the new columns to a local projection of it
+  start_df = start_df[['project', 'pseudonym', 'workflow_id', 'workflow_name']].assign(
+    day = start_df['local.started_at'].apply(convert_day),
+    period = start_df['local.started_at'].apply(convert_period),
+  )
+
+  #Put (a slice of) start_df into time order, and name the days and periods
+  #The slice index is for start_df in its original order, so we slice first and then sort. As the sort is stable, this gives
+  #the same result as slicing the sorted frame.
+  day_names = dict(enumerate(DAYS)) #Re https://stackoverflow.com/a/48472623
+  period_names = dict(enumerate(PERIODS))
+  def by_time(df):
+    df = df.sort_values(['day', 'period'])
+    return df.assign(day = df.day.map(day_names), period = df.period.map(period_names))
   PERIODS.reverse() #for the heatmap drawing
 
   print('Sample from start times table')
-  print(start_df.sample(5))
+  print(coding.decode(by_time(start_df).sample(5)))
 
   #Now do the drawing
   def draw_heatmap(title, heat_data, filepath, filename, identifier):
@@ -88,10 +100,9 @@ def start_times(start_df, subsets):
     fig['data'][2]['marker'] = marker_right
     for x in (1, 2): fig['data'][x]['opacity'] = 1
 
-    fig.write_image(filepath + '/static/' + filename + identifier + '.svg', width = 1600, height = 1200)
-    fig.write_image(filepath + '/static/' + filename + identifier + '.png', width = 1600, height = 1200)
+    render.write_images(fig, [filepath + '/static/' + filename + identifier + '.svg', filepath + '/static/' + filename + identifier + '.png'], width = 1600, height = 1200)
     fig.write_html(filepath + '/dynamic/' + filename + identifier + '.html', include_plotlyjs = 'directory')
-    heat_data.to_csv(filepath + '/' + filename + identifier + '.csv', mode = 'x')
+    coding.decode(heat_data).to_csv(filepath + '/' + filename + identifier + '.csv', mode = 'x')
 
   def random_heatmap(title, full_data, filepath, filename, identifier, iterations, fraction):
       title = f'{title}<br>Random {fraction:%} of all {len(full_data)} classifications)'
@@ -105,7 +116,7 @@ def start_times(start_df, subsets):
 
     if kwargs.get('box'):
       logfile = open(filepath + '/' + filename + '_desc.txt', 'x')
-      title = f'{label} ({n_v} volunteers)   [{u.git_condition()}]'
+      title = f'{label} ({n_v} volunteers)   [{u.RUN.condition}]'
       print(title, file = logfile)
       description = volunteer_classification_counts.describe([0.25, 0.75, 0.9, 0.95, 0.99])
       q1 = description['25%']
@@ -141,16 +152,16 @@ def start_times(start_df, subsets):
       title += '<br>' + description
 
       #Show the spread of volunteer classification counts
-      volunteer_classification_counts.to_csv(filepath + '/' + filename + '_box.csv', mode = 'x')
-      fig = px.box(volunteer_classification_counts, #x = 'workflow_name', y = session_df.duration.apply(lambda x: x.ceil('T').total_seconds()/60),
+      labelled_counts = coding.decode_index(volunteer_classification_counts, 'pseudonym')
+      labelled_counts.to_csv(filepath + '/' + filename + '_box.csv', mode = 'x')
+      fig = px.box(labelled_counts, #x = 'workflow_name', y = session_df.duration.apply(lambda x: x.ceil('T').total_seconds()/60),
                    points = 'suspectedoutliers', notched = True,
                    title = title, labels = { 'y': 'Classifications', 'x': ''}, log_y = True)
       fig.update_traces(quartilemethod = 'linear')
-      fig.write_image(filepath + '/static/' + filename + '_box.svg', width = 1600, height = 1200)
-      fig.write_image(filepath + '/static/' + filename + '_box.png', width = 1600, height = 1200)
+      render.write_images(fig, [filepath + '/static/' + filename + '_box.svg', filepath + '/static/' + filename + '_box.png'], width = 1600, height = 1200)
       fig.write_html(filepath + '/dynamic/' + filename + '_box.html', include_plotlyjs = 'directory')
 
-      base_title = f'{label} per weekday and period, in local time  [{u.git_condition()}]'
+      base_title = f'{label} per weekday and period, in local time  [{u.RUN.condition}]'
 
       #<= q3 of classification counts
       low_pseudonyms  = volunteer_classification_counts[volunteer_classification_counts.le(q3)].index.copy().values
@@ -182,7 +193,7 @@ def start_times(start_df, subsets):
       random_heatmap(base_title, data, filepath, filename, '_r', 5, 0.25)
 
     #Compute the heatmaps of when classifications happened
-    title = f'{label} per weekday and period, in local time ({n_v} volunteers)  [{u.git_condition()}]'
+    title = f'{label} per weekday and period, in local time ({n_v} volunteers)  [{u.RUN.condition}]'
     if n_v != n_class:
         mean_v = volunteer_classification_counts.mean()
         std_v = volunteer_classification_counts.std()
@@ -190,7 +201,6 @@ def start_times(start_df, subsets):
         title += f'<br>{n_class} classifications ({n_v} volunteers, {n_class} classifications, median = {med_v}, mean = {mean_v:.2f} (\u03C3 = {std_v:.2f}))'
     draw_heatmap(title, data, filepath, filename, '')
 
-  procs = []
   for label, df, box in [('all classifiers', start_df, True)]:
     proj_path = u.path_norm(f'secrets/graphs/{d.HEAD}/class_times/project/{label}')
     flow_path = u.path_norm(f'secrets/graphs/{d.HEAD}/class_times/workflow/{label}')
@@ -200,37 +210,20 @@ def start_times(start_df, subsets):
       os.makedirs(flow_path + '/' + x)
       os.makedirs(type_path + '/' + x)
     
-    title = f'Classifications by {label}  [{u.git_condition()}]'
+    title = f'Classifications by {label}  [{u.RUN.condition}]'
     print(f'Drawing {title}...')
 
     #By project
     for project, wids in d.PROJECTS.items():
       print(f'  ... for project {project!r}')
-      if SINGLE:
-        drawit                              (f'{title}<br>All workflows in project <b>{project!r}</b>', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project),             box = box)
-      else:
-        p = Process(target = drawit, args = (f'{title}<br>All workflows in project <b>{project!r}</b>', df[df.workflow_id.isin(wids)], proj_path, u.fnam_norm(project)), kwargs = {'box': box})
-        p.start()
-        procs.append(p)
+      pool.submit(drawit, f'{title}<br>All workflows in project <b>{project!r}</b>', by_time(slices.project(project, df)), proj_path, u.fnam_norm(project), box = box)
 
     #By workflow
     for workflow, wid in list(zip(d.WORKFLOWS, d.WORKFLOWS.index)):
       print(f'  ... for workflow {workflow!r} ({d.LABELS[wid]})')
-      if SINGLE:
-        drawit                              (f'{title}<br>Workflow <b>{d.LABELS[wid]}</b>', df[df.workflow_id == wid], flow_path, u.fnam_norm(workflow),             box = box)
-      else:
-        p = Process(target = drawit, args = (f'{title}<br>Workflow <b>{d.LABELS[wid]}</b>', df[df.workflow_id == wid], flow_path, u.fnam_norm(workflow)), kwargs = {'box': box})
-        p.start()
-        procs.append(p)
+      pool.submit(drawit, f'{title}<br>Workflow <b>{d.LABELS[wid]}</b>', by_time(slices.workflow(wid, df)), flow_path, u.fnam_norm(workflow), box = box)
     
     #By workflow type
     for w_type, wids in d.WORKFLOW_TYPES_BACKMAP.items():
       print(f'  ... for workflow type {w_type!r}')
-      if SINGLE:
-        drawit                              (f'{title}<br>All workflows of type <b>{w_type}</b>', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type),             box = box)
-      else:
-        p = Process(target = drawit, args = (f'{title}<br>All workflows of type <b>{w_type}</b>', df[df.workflow_id.isin(wids)], type_path, u.fnam_norm(w_type)), kwargs = {'box': box})
-        p.start()
-        procs.append(p)
-  if not SINGLE:
-    for p in procs: p.join()
+      pool.submit(drawit, f'{title}<br>All workflows of type <b>{w_type}</b>', by_time(slices.workflow_type(w_type, df)), type_path, u.fnam_norm(w_type), box = box)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+#Opt-in integer coding of the string columns that the analyses group and filter on (see analyze.py --coded).
+#data.dtypes keeps these as str because 'category' does not filter in the way that you would expect (unused categories
+#stay around, and turn up again in groupby and value_counts). So this does not use category: a coded column is a plain
+#int64 column, and it filters, groups and counts exactly as the int workflow_id column does -- only the values that
+#are actually present in a frame are ever seen.
+#
+#encode() replaces each of COLUMNS with its codes, and records the lookup table (label for each code) in LABELS.
+#Codes are assigned in sorted label order, so sorting or grouping on the codes gives the same order as on the labels.
+#
+#Analyses that might be handed a coded frame should:
+#  * compare a coded column against code(column, label), or use isin(codes(column, labels)), rather than the label
+#  * pass anything that is going to be written out (CSVs, charts, printouts) through decode() or decode_index()
+#All of these are no-ops if encode() has not been called, so the same analysis code runs on the plain string frame.
+COLUMNS = ['pseudonym', 'project', 'workflow_name']
+
+#Column name: pd.Index of labels, in code order
+LABELS = {}
+
+#Return a copy of df with each of COLUMNS replaced by its integer codes, and record the lookup tables in LABELS
+def encode(df):
+  coded = {}
+  for column in COLUMNS:
+    values, labels = pd.factorize(df[column], sort = True)
+    if (values == -1).any(): raise Exception(f'Cannot encode missing values in {column}')
+    coded[column] = values.astype(np.int64)
+    LABELS[column] = labels
+  return df.assign(**coded)
+
+#The value that label has in column: the label itself if the column is not coded, otherwise its code
+#A label that was not present when the frame was encoded gets code -1, which matches nothing
+def code(column, label):
+  if not column in LABELS: return label
+  return LABELS[column].get_indexer([label])[0]
+
+#As code, for a list-like of labels, for use with isin
+def codes(column, labels):
+  if not column in LABELS: return labels
+  return LABELS[column].get_indexer(labels)
+
+#Labels for values from column
+def _labels(column, values):
+  return LABELS[column].take(values).values
+
+#Return frame df with labels in place of the codes in any coded columns (as a copy, unless there is nothing to decode)
+def decode(df):
+  coded = [column for column in LABELS if column in df.columns]
+  if not coded: return df
+  return df.assign(**{column: _labels(column, df[column]) for column in coded})
+
+#Return x (a series or frame) with labels in place of the codes in its index, which is indexed by column
+def decode_index(x, column):
+  if not column in LABELS: return x
+  x = x.copy(deep = False)
+  x.index = pd.Index(_labels(column, x.index), name = x.index.name)
+  return x
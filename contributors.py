@@ -1,7 +1,11 @@
 import data as d
+import coding
 import numpy as np
 
-def contributors(df, subsets):
+def contributors(df, slices, subsets, pool):
+  pool.submit(breakdown, df, slices)
+
+def breakdown(df, slices):
   print('Breakdown of volunteers by number of projects contributed to')
   print('=' * len('Breakdown of volunteers by number of projects contributed to'))
 
@@ -28,7 +32,7 @@ def contributors(df, subsets):
   for project in d.HMS, d.SB, d.RBGE:
     #Starting with volunteers who contributed to 1 project, filter down to just the project of interest.
     x = projects.loc[c1.index] #Volunteers contributing to just one project
-    x = x.index.get_level_values('project') == project #All rows with project of interest
+    x = x.index.get_level_values('project') == coding.code('project', project) #All rows with project of interest
     x = np.count_nonzero(x) #in this context, counts the Trues
     mono_total += x
     header = f'{project} only:'
@@ -41,7 +45,7 @@ def contributors(df, subsets):
   for pair, exclusion in [[[d.HMS, d.SB], d.RBGE], [[d.HMS, d.RBGE], d.SB], [[d.SB, d.RBGE], d.HMS]]:
     x = projects.loc[c2.index] #Volunteers contributing to exactly 2 projects
     x = projects.reindex(c2.index, level = 0)
-    x = x[x.index.get_level_values('project') != exclusion]
+    x = x[x.index.get_level_values('project') != coding.code('project', exclusion)]
 
     #Now each pseudonym that appears twice has contributed to both projects
     #As we started with all pseudonyms that appear exactly twice (x = project.loc[c2.index]), now
@@ -60,10 +64,10 @@ def contributors(df, subsets):
 
   for project in d.HMS, d.SB, d.RBGE:
     heading = f'Total contributors to {project}:'
-    total = np.count_nonzero(projects.index.get_level_values('project') == project)
+    total = np.count_nonzero(projects.index.get_level_values('project') == coding.code('project', project))
     print(f'{heading:41}', total)
 
-    x = df[df.project == project] #All classifications on current project
+    x = slices.project(project) #All classifications on current project
     x = x.pseudonym.value_counts() #Number of classifications per volunteer on current project
 
     m_count = np.count_nonzero(x == 1)
@@ -384,7 +384,7 @@ Reproduction of this data requires access to the original classifications, which
 However, the reproduction recipe is:
 * git clone https://github.com/nationalarchives/engaging_crowds_user_analysis.git
 * cd engaging_crowds_user_analysis
-* git checkout {util.git_HEAD()} #Optional, to use the scripts at the point when this bundle was generated
+* git checkout {util.RUN.head} #Optional, to use the scripts at the point when this bundle was generated
 * pip install -r requirements.txt #You might prefer to do this in a virtualenv
 * (Download the original project export files from the relevant Engaging Crowds project(s) to engaging_crowds_user_analysis/exports/)
 * ./pseudonymise.py
@@ -435,7 +435,7 @@ The all_classifications.csv produced in this bundle is identical to the all_clas
 
   blurb += f'''
 
-This bundle generated from git state {util.git_condition()}
+This bundle generated from git state {util.RUN.condition}
 '''
 
   return blurb
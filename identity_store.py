@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+
+#Dictionary mapping user ids (or ip addrs) to pseudonyms, kept in SQLite so that a run only has to read the
+#identities that it actually needs and only has to write the ones that it adds.
+#The unique constraints on uid and pseudonym mean that the store itself guarantees that the mapping is one-to-one.
+#Nothing is written to disk until commit() is called.
+class IdentityStore(object):
+  def __init__(self, path):
+    self.path = path
+    self.db = sqlite3.connect(path)
+    self.db.execute('CREATE TABLE IF NOT EXISTS identities (uid TEXT PRIMARY KEY, pseudonym TEXT NOT NULL UNIQUE) WITHOUT ROWID')
+    self.db.execute('CREATE TEMP TABLE wanted (key TEXT PRIMARY KEY) WITHOUT ROWID')
+    self.db.commit()
+
+  def __len__(self):
+    return self.db.execute('SELECT COUNT(*) FROM identities').fetchone()[0]
+
+  #Join the given keys against the identities table on column, one query for the lot
+  def _match(self, keys, column):
+    self.db.execute('DELETE FROM wanted')
+    self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((k,) for k in keys))
+    return self.db.execute(f'SELECT identities.uid, identities.pseudonym FROM wanted JOIN identities ON identities.{column} = wanted.key')
+
+  #Dictionary of uid: pseudonym for those of uids that are already in the store
+  def lookup(self, uids):
+    return dict(self._match(uids, 'uid'))
+
+  #Set of those of pseudonyms that are already in use
+  def taken(self, pseudonyms):
+    return {pseudonym for _, pseudonym in self._match(pseudonyms, 'pseudonym')}
+
+  #Add new (uid, pseudonym) pairs
+  def add(self, pairs):
+    try:
+      self.db.executemany('INSERT INTO identities VALUES (?, ?)', pairs)
+    except sqlite3.IntegrityError as e:
+      raise Exception(f'Attempt to reuse a user id or pseudonym in {self.path}: {e}')
+
+  def commit(self):
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+  #Add the contents of a dictionary file in the old identities.json format
+  def import_json(self, path):
+    with open(path) as f:
+      self.add(json.load(f).items())
+
+  #Write the whole store out in the old identities.json format
+  def export_json(self, path):
+    with open(path, 'w') as f:
+      json.dump(dict(self.db.execute('SELECT uid, pseudonym FROM identities ORDER BY uid')), f, indent = 2, sort_keys = True)
+
+#True if there is no store at path, or there is one with nothing in it
+def is_empty(path):
+  if not os.path.exists(path): return True
+  store = IdentityStore(path)
+  try:
+    return len(store) == 0
+  finally:
+    store.close()
+
+#Make a store at path (replacing any that is there) holding the identities in json_path, in the old identities.json format
+#The store is built to one side and then moved into place, so that if this fails there is never a store at path
+#without those identities in it.
+def create_from_json(path, json_path):
+  tmp = f'{path}.{os.getpid()}.tmp'
+  try:
+    store = IdentityStore(tmp)
+    try:
+      store.import_json(json_path)
+      store.commit()
+    finally:
+      store.close()
+    os.replace(tmp, path)
+  finally:
+    if os.path.exists(tmp): os.unlink(tmp)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Convert between the identity store and the identities.json format')
+  parser.add_argument('store',
+                      help = 'SQLite identity store, as written by pseudonymize.py')
+  parser.add_argument('--import', dest = 'import_json',
+                      help = 'Add the identities in this JSON dictionary to the store (creating the store if need be)')
+  parser.add_argument('--export', dest = 'export_json',
+                      help = 'Write the identities in the store to this JSON dictionary')
+  args = parser.parse_args()
+  if args.export_json and not args.import_json and not os.path.exists(args.store):
+    raise Exception(f'No identity store at {args.store}')
+  if args.import_json and not os.path.exists(args.store):
+    create_from_json(args.store, args.import_json)
+    args.import_json = None
+  store = IdentityStore(args.store)
+  if args.import_json:
+    store.import_json(args.import_json)
+    store.commit()
+  if args.export_json:
+    store.export_json(args.export_json)
+  store.close()
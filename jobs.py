@@ -0,0 +1,161 @@
+import io
+import multiprocessing
+import multiprocessing.connection
+import sys
+import traceback
+
+import numpy as np
+
+import profiling
+import render
+
+_fork = multiprocessing.get_context('fork')
+
+class Task(object):
+  def __init__(self, pool, number, name):
+    self.pool = pool
+    self.number = number
+    self.name = name
+    self.done = False
+    self.value = None
+    self.output = ''
+
+  #Wait for the task to finish and return what it returned (or raise an exception if it failed)
+  def result(self):
+    while not self.done:
+      self.pool._reap()
+    return self.value
+
+#Runs tasks in forked child processes, at most jobs of them at a time, or just runs them in line if jobs is 1.
+#A child is forked when its task is submitted, so a task sees everything that the parent had at that point -- in
+#particular the prepared data and any frames derived from it -- without any of it being pickled. Only the return value
+#comes back to the parent, so tasks should return something small. Anything that writes to a shared resource (such as
+#the kaleido process that plotly uses for static images, if there is no render.Renderer) must happen in tasks, not in the
+#parent, while jobs > 1.
+#
+#While the pool is open, stdout is held back so that the log comes out in the same order that it would if everything
+#ran in line: a task's output (captured in the child) appears after anything printed before the task was submitted, and
+#before anything printed after that.
+#
+#With a seed, each task seeds numpy's global random number generator from seed and the task's number, so that random
+#samples do not depend on the number of jobs. Without one, each child is seeded afresh (otherwise they would all draw
+#the same numbers, inherited from the parent).
+#
+#If a task fails, the exception is raised in the parent (when the failure is noticed), and on leaving the with block
+#any tasks still running are killed.
+class Pool(object):
+  def __init__(self, jobs = 1, seed = None):
+    if jobs < 1: raise ValueError(f'Need at least one job, not {jobs}')
+    self.jobs = jobs
+    self.seed = seed
+    self.submitted = 0
+    self.running = []
+    self.pending = [] #Output not yet written: strings printed by the parent, and tasks
+
+  def __enter__(self):
+    self.stdout = sys.stdout
+    sys.stdout = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    try:
+      if exc_type is None:
+        while self.running:
+          self._reap()
+    finally:
+      for task in self.running:
+        task.process.kill()
+        task.process.join()
+      self.running = []
+      for entry in self.pending:
+        if isinstance(entry, str): self.stdout.write(entry)
+        else: self.stdout.write(entry.output)
+      self.pending = []
+      sys.stdout = self.stdout
+
+  def write(self, text):
+    if self.pending:
+      if isinstance(self.pending[-1], str): self.pending[-1] += text
+      else: self.pending.append(text)
+    else:
+      self.stdout.write(text)
+
+  def flush(self):
+    self.stdout.flush()
+
+  #Run fn(*args, **kwargs) as a task, returning a Task
+  def submit(self, fn, *args, **kwargs):
+    task = Task(self, self.submitted, f'{fn.__module__}.{fn.__qualname__} (task {self.submitted})')
+    self.submitted += 1
+    if self.jobs == 1:
+      if self.seed is None:
+        with profiling.stage(task.name):
+          task.value = fn(*args, **kwargs)
+      else:
+        #Leave the parent's random state as it would be if the task had run in a child
+        state = np.random.get_state()
+        self._seed(task.number)
+        try:
+          with profiling.stage(task.name):
+            task.value = fn(*args, **kwargs)
+        finally:
+          np.random.set_state(state)
+      task.done = True
+      return task
+
+    while len(self.running) >= self.jobs:
+      self._reap()
+    self.stdout.flush()
+    task.conn, child_conn = _fork.Pipe(duplex = False)
+    task.process = _fork.Process(target = self._child, args = (child_conn, task.number, task.name, fn, args, kwargs))
+    task.process.start()
+    child_conn.close()
+    self.running.append(task)
+    self.pending.append(task)
+    return task
+
+  def _seed(self, number):
+    if self.seed is not None:
+      np.random.seed([self.seed, number])
+
+  def _child(self, conn, number, name, fn, args, kwargs):
+    sys.stdout = io.StringIO()
+    if self.seed is None: np.random.seed()
+    else: self._seed(number)
+    try:
+      with profiling.stage(name):
+        result = (True, fn(*args, **kwargs))
+    except BaseException:
+      result = (False, traceback.format_exc())
+    try:
+      conn.send(result + (sys.stdout.getvalue(),))
+    except BaseException:
+      conn.send((False, traceback.format_exc(), sys.stdout.getvalue()))
+    conn.close()
+
+  #Wait for at least one running task to finish, and deal with whatever has finished
+  #Meanwhile, start the render.RENDERER's workers if a task asks for them.
+  def _reap(self):
+    renderer = render.RENDERER
+    wanted = renderer.wanted() if renderer else None
+    ready = multiprocessing.connection.wait([task.conn for task in self.running] + ([wanted] if wanted else []))
+    if wanted in ready:
+      renderer.start()
+      ready.remove(wanted)
+      if not ready: return
+    for task in [task for task in self.running if task.conn in ready]:
+      try:
+        ok, task.value, task.output = task.conn.recv()
+      except EOFError:
+        task.process.join()
+        ok, task.value = False, f'Process exited with code {task.process.exitcode}, without a result'
+      task.conn.close()
+      task.process.join()
+      self.running.remove(task)
+      task.done = True
+      while self.pending and (isinstance(self.pending[0], str) or self.pending[0].done):
+        entry = self.pending.pop(0)
+        self.stdout.write(entry if isinstance(entry, str) else entry.output)
+      if not ok:
+        error, task.value = task.value, None
+        raise Exception(f'{task.name} failed:\n{error}')
@@ -1,4 +1,3 @@
-import sys
 import util
 from os import linesep as nl
 
@@ -256,7 +255,7 @@ Reproduction of this data requires access to the original classifications, which
 However, the reproduction recipe is:
 * git clone https://github.com/nationalarchives/engaging_crowds_user_analysis.git
 * cd engaging_crowds_user_analysis
-* git checkout {util.git_HEAD()} #Optional, to use the scripts at the point when this bundle was generated
+* git checkout {util.RUN.head} #Optional, to use the scripts at the point when this bundle was generated
 * pip install -r requirements.txt #You might prefer to do this in a virtualenv
 * (Download the original project export files from the relevant Engaging Crowds project(s) to engaging_crowds_user_analysis/exports/)
 * ./pseudonymise.py
@@ -273,10 +272,10 @@ consistent (identify the same user) across Engaging Crowds projects, including i
 phase 2 that are based on IP address (beginning 'anon:') cannot meaningfully be compared with the phase 1 HMS NHS data or with
 other Engaging Crowds projects.
 
-This bundle generated from git state {util.git_condition()}
+This bundle generated from git state {util.RUN.condition}
 
 This bundle generated with the command:
-{' '.join(sys.argv)}
+{' '.join(util.RUN.argv)}
 '''
 
   return blurb
@@ -0,0 +1,148 @@
+import atexit
+import cProfile
+import json
+import os
+import resource
+import time
+
+import util as u
+
+#The Profiler that stages are recorded by, if profiling is on
+PROFILER = None
+
+#Stages entered, but not yet left, in this process (innermost last)
+_open = []
+
+#A forked process carries on with its own stages, so it must not think that it is inside its parent's, nor carry on
+#feeding its parent's cProfile (which it would never write out)
+def _after_fork():
+  global _open
+  for s in _open:
+    if s.profile: s.profile.disable()
+  _open = []
+os.register_at_fork(after_in_child = _after_fork)
+
+#Something that we want to know the cost of, as a context manager:
+#  with profiling.stage('load') as s:
+#    df = load()
+#    s.rows = len(df)
+#This is cheap enough to leave in place: it does nothing unless profiling has been started.
+#rows, if given (when starting the stage or at any time before it ends), is the number of rows that the stage worked
+#through, from which we get its throughput.
+class stage(object):
+  def __init__(self, name, rows = None):
+    self.name = name
+    self.rows = rows
+    self.profile = None
+
+  def __enter__(self):
+    if PROFILER: PROFILER._enter(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if PROFILER: PROFILER._exit(self, exc_type is None)
+
+def _children_cpu():
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+def _peak_rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 #ru_maxrss is in KiB on Linux
+
+#Records wall time, CPU time, peak RSS and throughput of each stage, in whichever process it runs, and writes them all
+#out as a JSON report at the end of the run.
+#
+#CPU time is that of the process that the stage runs in, with that of any child processes that finished during the stage
+#counted separately. Peak RSS is the high water mark of the process that the stage runs in, as at the end of the stage:
+#rss_growth_mb is how much the stage raised it.
+#
+#Each process appends its stages to a file as they finish, so that stages in forked processes (jobs, renderers, JSON
+#workers) are recorded without having to pass anything back. With cprofile_dir, each outermost stage in a process is
+#also run under cProfile, and its stats are dumped into cprofile_dir (for pstats or snakeviz).
+class Profiler(object):
+  def __init__(self, report, cprofile_dir = None):
+    self.report = report
+    self.cprofile_dir = cprofile_dir
+    self.pid = os.getpid()
+    self.started = time.time()
+    self.wall = time.perf_counter()
+    self.cpu = time.process_time()
+    self.records = report + '.tmp'
+    self.fd = os.open(self.records, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+    self.count = 0
+    if cprofile_dir:
+      os.makedirs(cprofile_dir, exist_ok = True)
+
+  def _enter(self, s):
+    s.parent = _open[-1].name if _open else None
+    s.started = time.time()
+    s.wall = time.perf_counter()
+    s.cpu = time.process_time()
+    s.children_cpu = _children_cpu()
+    s.rss = _peak_rss_mb()
+    if self.cprofile_dir and not _open:
+      s.profile = cProfile.Profile()
+      s.profile.enable()
+    _open.append(s)
+
+  def _exit(self, s, ok):
+    wall = time.perf_counter() - s.wall
+    cpu = time.process_time() - s.cpu
+    if s.profile:
+      s.profile.disable()
+      self.count += 1
+      s.profile.dump_stats(f'{self.cprofile_dir}/{os.getpid()}_{self.count}_{u.fnam_norm(s.name)}.prof')
+      s.profile = None
+    if _open and _open[-1] is s: _open.pop()
+    peak = _peak_rss_mb()
+    record = {
+      'name': s.name,
+      'parent': s.parent,
+      'pid': os.getpid(),
+      'ok': ok,
+      'start_s': round(s.started - self.started, 6),
+      'wall_s': round(wall, 6),
+      'cpu_s': round(cpu, 6),
+      'children_cpu_s': round(_children_cpu() - s.children_cpu, 6),
+      'peak_rss_mb': round(peak, 1),
+      'rss_growth_mb': round(peak - s.rss, 1),
+      'rows': None if s.rows is None else int(s.rows),
+      'rows_per_s': round(s.rows / wall, 1) if s.rows is not None and wall > 0 else None,
+    }
+    os.write(self.fd, (json.dumps(record) + '\n').encode('utf-8')) #One write, so that lines from different processes do not get mixed up
+
+  #Gather up the stages from all of the processes into the report
+  def write(self):
+    os.close(self.fd)
+    with open(self.records) as f:
+      stages = [json.loads(line) for line in f]
+    stages.sort(key = lambda x: x['start_s'])
+    report = {
+      'run': {
+        'wall_s': round(time.perf_counter() - self.wall, 6),
+        'cpu_s': round(time.process_time() - self.cpu, 6),
+        'children_cpu_s': round(_children_cpu(), 6),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'cprofile_dir': self.cprofile_dir,
+      },
+      'manifest': u.RUN.to_dict() if u.RUN else None,
+      'stages': stages,
+    }
+    with open(self.report, 'w') as f:
+      json.dump(report, f, indent = 2)
+    os.unlink(self.records)
+    print(f'Profile written to {self.report}')
+
+#Start profiling, according to mode ('off', 'stages' or 'cprofile', as given by --profile), with the report written to
+#report when the run ends (however it ends). cProfile stats go in a directory alongside the report.
+def start(mode, report):
+  global PROFILER
+  if mode == 'off': return None
+  PROFILER = Profiler(report, os.path.splitext(report)[0] + '_cprofile' if mode == 'cprofile' else None)
+  atexit.register(_finish, PROFILER)
+  return PROFILER
+
+def _finish(profiler):
+  if os.getpid() == profiler.pid: #Forked processes that exit through sys.exit would otherwise get here too
+    profiler.write()
+
@@ -3,25 +3,43 @@
 import pandas as pd
 import numpy as np
 import csv
+import filecmp
+import hashlib
 import argparse
+import io
 import json
 import os
 import sys
 import secrets
-import string
 import tempfile
-import shutil
+import zipfile
 import importlib
+import multiprocessing
 import util
-from collections import Counter
+import identity_store
+import profiling
+from functools import partial
+
+#orjson is a much faster JSON parser, but we can manage without it
+try:
+  import orjson
+  json_loads = orjson.loads
+except ImportError:
+  json_loads = json.loads
 
 #For debugging
 #pd.set_option('display.max_columns', None)
 #pd.set_option('display.max_rows', None)
 #pd.set_option('display.expand_frame_repr', None)
 
-#Dictionary storing individual CSV files minimally altered
-minimal_pseudonyms = {}
+#Below this many rows, it is quicker to extract JSON fields in-process than to farm them out to workers
+JSON_PARALLEL_MIN_ROWS = 50000
+
+#Rows per workflow version to check when validating JSON extraction with --validate=sample
+VALIDATE_SAMPLE_SIZE = 1000
+
+#Rows per chunk when re-reading the exports to write the minimally altered per-workflow files
+MINIMAL_CHUNKSIZE = 100000
 
 def config_checks():
   def compare(comparator):
@@ -43,97 +61,178 @@ def config_checks():
     with open(args.dictionary, 'w') as f: pass #confirm that we can write a file here
     os.unlink(args.dictionary)
 
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ%z'
+
+#Parsed subjects exports are cached here. Bump the version whenever the layout of the cached tables changes.
+SUBJECTS_CACHE_DIR = 'secrets/subjects_cache'
+SUBJECTS_CACHE_VERSION = 1
+
+#Where --incremental keeps track of how far it has got through each export. Bump the version whenever the layout of the file changes.
+WATERMARKS = 'secrets/watermarks.json'
+WATERMARKS_VERSION = 2
+
+#Record of the most recent run: git state, command line and config (see util.RunManifest)
+MANIFEST = 'secrets/pseudonymize_manifest.json'
+#Where --profile puts its report (see profiling.py)
+PROFILE = 'secrets/pseudonymize_profile.json'
+
+#Sorted classification ids of everything in the sharing/ outputs, for use as --exclusions in a later phase
+EXCLUSION_INDEX = 'sharing/classification_ids.npy'
+#Classification ids pulled out of CSV files given as --exclusions are kept here, so that each CSV only has to be read once
+EXCLUSIONS_CACHE_DIR = 'secrets/exclusions_cache'
+
+#We have to use the subjects file to get the subject set id.
+#If I understand correctly, this file is NOT synchronized with the
+#classifications and does not record historical information, but
+#rather just the membership of the subjects at the time that it was
+#generated. This means that if a subject has moved from one subject
+#set to another, or been removed from workflow, it will not appear in
+#this file.
+#So we hope that the subject files that we are working with
+#accurately describe the current subject_set for each subject.
+#If this does not hold, then we can at least get the 'raw' location of the
+#subject (location.zooniverse.plain in the below), so long as the subject id
+#is mentioned somewhere in this file.
+#If the subject id is not in the file at all then we give up. I suppose
+#that it might be possible to use a subject set id known to be associated
+#with a workflow to generate a URL for it -- but if it is not in this file,
+#it seems unlikely that that URL would be valid.
+#For some projects we can also point to file locations on the home
+#institution's site.
+#We parse each subject's location once, and attach locations to classifications
+#by lookup. Note that the 'location.zooniverse.project' field can legitimately
+#have different values for the same subject, depending upon which workflow
+#it was classified in and which subject set it belonged to.
+def read_subjects(project):
+  source = f'{args.exports}/{config.SUBJECTS[project]}'
+  if not args.subjects_cache:
+    return parse_subjects(source)
+
+  #The subjects exports are big and change rarely, so keep the parsed tables in secrets/ and only rebuild them when the export changes
+  cache = f'{SUBJECTS_CACHE_DIR}/{util.fnam_norm(config.SUBJECTS[project])}'
+  meta = None
+  if os.path.exists(f'{cache}.json'):
+    with open(f'{cache}.json') as f:
+      meta = json.load(f)
+    if meta['version'] != SUBJECTS_CACHE_VERSION or meta['format'] != util.FRAME_FORMAT:
+      meta = None
+  signature = util.file_signature(source, meta and meta['source'])
+  if meta and meta['source']['sha256'] == signature['sha256']:
+    subject_sets = util.load_frame(f'{cache}.sets').set_index(['subject_id', 'workflow_id'])
+    subject_locations = util.load_frame(f'{cache}.locations').set_index('subject_id')
+  else:
+    print(f'Parsing {source}')
+    subject_sets, subject_locations = parse_subjects(source)
+    os.makedirs(SUBJECTS_CACHE_DIR, exist_ok = True)
+    util.save_frame(subject_sets.reset_index(), f'{cache}.sets')
+    util.save_frame(subject_locations.reset_index(), f'{cache}.locations')
+  if signature != (meta and meta['source']):
+    with open(f'{cache}.json', 'w') as f:
+      json.dump({'version': SUBJECTS_CACHE_VERSION, 'format': util.FRAME_FORMAT, 'source': signature}, f, indent = 2)
+  return subject_sets, subject_locations
+
+def parse_subjects(source):
+  subj_df = pd.read_csv(source, usecols = ['subject_id', 'workflow_id', 'subject_set_id', 'locations'])
+  return subject_sets_table(subj_df), subject_locations_table(subj_df)
+
+#Subject set for each (subject_id, workflow_id) pair, for the 'project' location
+#'ok' is False where there is not a single integer subject_set_id for the pair
+def subject_sets_table(subj_df):
+  sets = subj_df[['subject_id', 'workflow_id', 'subject_set_id']]
+  single = ~sets.duplicated(['subject_id', 'workflow_id'], keep = False)
+  sets = sets.assign(ok = single & sets.subject_set_id.notna() & pd.api.types.is_integer_dtype(sets.subject_set_id))
+  sets = sets.drop_duplicates(['subject_id', 'workflow_id'])
+  return sets.set_index(['subject_id', 'workflow_id'])
+
+#Parsed 'raw' location for each subject_id, with any warning or error to report if the subject is classified
+def subject_locations_table(subj_df):
+  table = {}
+  for sid, locs in subj_df.groupby('subject_id', sort = False).locations.unique().items():
+    warning = None
+    error = None
+    location = '<UNLISTED SUBJECT>'
+    if len(locs) == 1: loc = locs[0]
+    else:
+      #We assume that all of the locations show the same image
+      warning = f'Using final of multiple locations for subject {sid}'
+      loc = locs[-1]
+    loc = json.loads(loc)
+
+    #Make sure that the data is shaped as we expect
+    if len(loc) != 1:
+      if len(loc) > 1: error = f'Encountered multiple locations for subject_id {sid} in single row'
+      else: error = f'Missing location for subject_id {sid}'
+    elif not '0' in loc:
+      error = f'Location missing key "0" for subject_id {sid} -- should be its only key'
+    elif len(loc['0'].strip()) == 0:
+      warning = f'Empty subjects file entry for subject_id {sid}'
+    else:
+      location = loc['0']
+    table[sid] = (location, warning, error)
+  return pd.DataFrame.from_dict(table, orient = 'index', columns = ['location', 'warning', 'error']).rename_axis('subject_id')
+
+#Messages that have already gone to stderr, so that we report each subject once rather than once per classification
+_subject_warnings = set()
+def warn_subject(message):
+  if not message in _subject_warnings:
+    _subject_warnings.add(message)
+    print(message, file = sys.stderr)
+
+#Add the location.* columns to a project's classifications, using the tables from read_subjects
+def locate_subjects(project, proj_df, subject_sets, subject_locations):
+  if project in config.LOCATION_FIXUPS:
+    config.LOCATION_FIXUPS[project](proj_df)
+
+  #The 'project' location
+  pairs = subject_sets.reindex(pd.MultiIndex.from_arrays([proj_df.subject_ids, proj_df.workflow_id]))
+  missing = pairs.ok.isna().to_numpy()
+  for sid, wid in pairs.index[missing].unique():
+    warn_subject(f'No subjects file entry for subject {sid} with workflow {wid}')
+  if (pairs.ok[~missing] == False).any():
+    #This constraint might not hold for other projects, but I expect it to be true
+    #across the Engaging Crowds family. If it breaks down then the code will need modification
+    #to handle a single subject in multiple subject sets -- whether this is caused by that
+    #currently being the case, or by the file choosing to keep an entry for each subject_id that
+    #a subject set has ever belonged to (if, indeed, it is allowed to do that)
+    raise Exception('Expected single integer value for subject_set_id for subject in workflow')
+  subj_set = pairs.subject_set_id.to_numpy()[~missing].astype(np.int64).astype(str)
+  location = np.full(len(proj_df), '<MISSING SUBJECT SET ID>', dtype = object)
+  location[~missing] = (config.PROJECT_URLS[project] + 'classify/workflow/' + proj_df.workflow_id[~missing].astype(str) +
+                        '/subject-set/' + subj_set + '/subject/' + proj_df.subject_ids[~missing].astype(str)).to_numpy()
+  proj_df['location.zooniverse.project'] = location
+
+  #The 'raw' location
+  locs = subject_locations.reindex(proj_df.subject_ids.unique())
+  for sid in locs.index[locs.location.isna()]:
+    warn_subject(f'No subjects file entry for subject_id {sid}')
+  for error in locs.error.dropna():
+    raise Exception(error)
+  for warning in locs.warning.dropna():
+    warn_subject(warning)
+  proj_df['location.zooniverse.plain'] = proj_df.subject_ids.map(locs.location.fillna('<UNLISTED SUBJECT>')).to_numpy()
+  if project in config.ZOONIVERSE_LOCATION_FIXUPS:
+    config.ZOONIVERSE_LOCATION_FIXUPS[project](proj_df)
+
+  return proj_df
+
+#Package up a project's classifications for the data sharing platform
+#classifications is the CSV, as a source for util.write_archives
+def archive_project(project, classifications):
+  basedir = f'{util.fnam_norm(project)}_data'
+  with profiling.stage(f'archive_project {project}'):
+    util.write_archives(f'sharing/{util.fnam_norm(project)}', [
+      (f'{basedir}/README.txt', config.readme_blurb([project]).encode('utf-8')),
+      (f'{basedir}/classifications.csv', classifications),
+    ])
+
 def make_shareables(copied_df):
   for project, wids in config.PROJECTS.items():
     print(f'  {project}')
-    proj_df = copied_df[copied_df.workflow_id.isin(wids)].drop('START', axis = 'columns').dropna(axis='columns', how = 'all')
-
-    #We have to use the subjects file to get the subject set id.
-    #If I understand correctly, this file is NOT synchronized with the
-    #classifications and does not record historical information, but
-    #rather just the membership of the subjects at the time that it was
-    #generated. This means that if a subject has moved from one subject
-    #set to another, or been removed from workflow, it will not appear in
-    #this file.
-    #So we hope that the subject files that we are working with
-    #accurately describe the current subject_set for each subject.
-    #If this does not hold, then we can at least get the 'raw' location of the
-    #subject (location.zooniverse.plain in the below), so long as the subject id
-    #is mentioned somewhere in this file.
-    #If the subject id is not in the file at all then we give up. I suppose
-    #that it might be possible to use a subject set id known to be associated
-    #with a workflow to generate a URL for it -- but if it is not in this file,
-    #it seems unlikely that that URL would be valid.
-    #For some projects we can also point to file locations on the home
-    #institution's site.
-    #(In principle it is more efficient to compute subject locations once,
-    #but we do it per-classification. This is partly because it makes for
-    #simpler code -- thus easier to understand/maintain/reuse. Note also
-    #that the 'location.zooniverse.project' field can legitimately
-    #have different values for the same subject, depending upon which workflow
-    #it was classified in and which subject set it belonged to.)
-    subj_df = pd.read_csv(f'{args.exports}/{config.SUBJECTS[project]}',
-                          usecols = ['subject_id', 'workflow_id', 'subject_set_id', 'locations'])
-    subj_sets = subj_df.set_index(['subject_id', 'workflow_id']).subject_set_id
-    subj_locs = subj_df.set_index('subject_id').locations
-    if project in config.LOCATION_FIXUPS:
-      config.LOCATION_FIXUPS[project](proj_df)
-
-    #This function is only needed to get the 'project' location
-    def get_subject_set_id(row):
-      subj_set = None
-      try:
-        subj_set = subj_sets.loc[(row['subject_ids'], row['workflow_id'])]
-      except KeyError:
-        print(f'No subjects file entry for subject {row.subject_ids} with workflow {row.workflow_id}', file = sys.stderr)
-        return f"<MISSING SUBJECT SET ID>"
-      if not isinstance(subj_set, np.int64):
-        #This constraint might not hold for other projects, but I expect it to be true
-        #across the Engaging Crowds family. If it breaks down then the code will need modification
-        #to handle a single subject in multiple subject sets -- whether this is caused by that
-        #currently being the case, or by the file choosing to keep an entry for each subject_id that
-        #a subject set has ever belonged to (if, indeed, it is allowed to do that)
-        raise Exception('Expected single integer value for subject_set_id for subject in workflow')
-      return f"{config.PROJECT_URLS[project]}classify/workflow/{row['workflow_id']}/subject-set/{subj_set}/subject/{row['subject_ids']}"
-    proj_df['location.zooniverse.project'] = proj_df.apply(get_subject_set_id, axis = 1)
-
-    #This function is only needed to get the 'raw' location
-    def parse_subj_loc(sid):
-      if not sid in subj_locs:
-        print(f'No subjects file entry for subject_id {sid}', file = sys.stderr)
-        return '<UNLISTED SUBJECT>'
-      loc = subj_locs.loc[sid]
-      if isinstance(loc, pd.Series):
-        loc = loc.unique() #Returns ndarray or ExtensionArray. I'm assuming len and [] work the same either way.
-        if len(loc) == 1: loc = loc[0]
-        else:
-          #We assume that all of the locations show the same image
-          print(f'Using final of multiple locations for subject {sid}', file = sys.stderr)
-          loc = loc[-1]
-      loc = json.loads(loc)
-
-      #Make sure that the data is shaped as we expect
-      if len(loc) != 1:
-        if len(loc > 1): raise Exception(f'Encountered multiple locations for subject_id {sid} in single row')
-        else: raise Exception(f'Missing location for subject_id {sid}')
-      if not '0' in loc:
-        raise Exception('Location missing key "0" for subject_id {sid} -- should be its only key')
-      if len(loc['0'].strip()) == 0:
-        print(f'Empty subjects file entry for subject_id {sid}', file = sys.stderr)
-        return '<UNLISTED SUBJECT>'
-      else: return loc['0']
-    proj_df['location.zooniverse.plain'] = proj_df.subject_ids.apply(parse_subj_loc)
-    if project in config.ZOONIVERSE_LOCATION_FIXUPS:
-      config.ZOONIVERSE_LOCATION_FIXUPS[project](proj_df)
-
-    with tempfile.TemporaryDirectory('.') as tmpdir:
-      basedir = f'{tmpdir}/{util.fnam_norm(project)}_data'
-      os.mkdir(basedir)
-      with open(f'{basedir}/README.txt', 'w') as f:
-        f.write(config.readme_blurb([project]))
-      proj_df.to_csv(f'{basedir}/classifications.csv', index = False, date_format='%Y-%m-%dT%H:%M:%S.%fZ%z')
-      for ar_format in ('zip', 'xztar'):
-        shutil.make_archive(f'sharing/{util.fnam_norm(project)}', ar_format, tmpdir)
+    with profiling.stage(f'make_shareables {project}') as s:
+      proj_df = copied_df[copied_df.workflow_id.isin(wids)].drop('START', axis = 'columns').dropna(axis='columns', how = 'all')
+      s.rows = len(proj_df)
+      proj_df = locate_subjects(project, proj_df, *read_subjects(project))
+      archive_project(project, util.csv_source(proj_df, index = False, date_format = DATE_FORMAT))
 
 parser = argparse.ArgumentParser()
 parser.add_argument('workflows',
@@ -144,8 +243,12 @@ parser.add_argument('--exports', '-e',
                    default = 'exports',
                    help = 'Location of exported classifications files')
 parser.add_argument('--dictionary', '-d',
-                    default = 'secrets/identities.json',
-                    help = 'Dictionary file to record the pseudonymisation result')
+                    default = 'secrets/identities.sqlite',
+                    help = 'Identity store to record the pseudonymisation result. If it does not exist yet, it starts out with the contents of --import-dictionary.')
+parser.add_argument('--import-dictionary',
+                    help = 'JSON dictionary file (as written by earlier versions of this script) to start a new identity store from. Defaults to the --dictionary path with a .json extension, if there is a file there.')
+parser.add_argument('--export-dictionary',
+                    help = 'Also write the identity store out to this JSON dictionary file at the end of the run')
 parser.add_argument('--config',
                     default = 'data',
                     help = 'Python file to set the built-in configuration')
@@ -158,15 +261,55 @@ parser.add_argument('--all-classifications',
                     default = False,
                     help = 'Output a single file with classifications from all projects')
 parser.add_argument('--exclusions',
-                    help = 'Output of an earlier run of this program, containing classifications to be excluded from this run')
+                    help = f'Output of an earlier run of this program, containing classifications to be excluded from this run. Either a CSV file with a classification_id column or an {EXCLUSION_INDEX}.')
 parser.add_argument('--exclusions-override',
                     action = 'append',
                     type = int,
+                    default = [],
                     help = 'List of classification ids to include even if they would otherwise be excluded')
+parser.add_argument('--json-workers',
+                    type = int,
+                    default = 1,
+                    help = 'Number of worker processes to use when pulling fields out of JSON columns')
+parser.add_argument('--validate',
+                    choices = ['full', 'sample', 'off'],
+                    default = 'full',
+                    help = 'Check extracted JSON fields against the original JSON for every row, for a sample of rows from each workflow version, or not at all')
+parser.add_argument('--verify-dates',
+                    choices = ['full', 'sample', 'off'],
+                    default = 'sample',
+                    help = 'Check the parsed metadata timestamps against the (much slower) general-purpose date parser for every value, for a sample of values, or not at all')
+parser.add_argument('--chunksize',
+                    type = int,
+                    help = 'Stream each export through the whole pipeline in chunks of this many rows, rather than loading everything at once')
+parser.add_argument('--verify-chunked',
+                    action = argparse.BooleanOptionalAction,
+                    default = False,
+                    help = 'With --chunksize, also run without chunks afterwards and check that the outputs are exactly the same (slow)')
+parser.add_argument('--subjects-cache',
+                    action = argparse.BooleanOptionalAction,
+                    default = True,
+                    help = f'Cache parsed subjects exports in {SUBJECTS_CACHE_DIR}')
+parser.add_argument('--exclusion-index',
+                    action = argparse.BooleanOptionalAction,
+                    default = True,
+                    help = f'Write the classification ids of everything in the sharing/ outputs to {EXCLUSION_INDEX}')
+parser.add_argument('--incremental',
+                    action = argparse.BooleanOptionalAction,
+                    default = False,
+                    help = f'Only process classifications added to the exports since the last incremental run, appending them to the existing outputs. Falls back to a full rebuild if anything else has changed. Progress is recorded in {WATERMARKS}.')
+parser.add_argument('--profile',
+                    choices = ['off', 'stages', 'cprofile'],
+                    nargs = '?',
+                    const = 'stages',
+                    default = 'off',
+                    help = f'Record wall time, CPU time, peak memory and throughput of each stage (reading each workflow, JSON expansion, pseudonymisation, each per-project output...) in {PROFILE}. --profile on its own is --profile=stages. With cprofile, also dump cProfile stats for each stage.')
 args = parser.parse_args()
 config = importlib.import_module(args.config)
 if args.config_checks:
   config_checks()
+util.start_run(config, args).write(MANIFEST)
+profiling.start(args.profile, PROFILE)
 if len(args.workflows) == 0:
   args.workflows = list(config.WORKFLOW_NAMES.keys())
 else:
@@ -178,255 +321,785 @@ for workflow in args.workflows:
   if not workflow in config.WORKFLOW_KEEPERS:
     raise Exception(f'Workflow "{workflow}" unknown to this script.')
 
-if os.path.exists(args.dictionary):
-  with open(args.dictionary) as f:
-    identities = json.loads(f.read())
+#Pseudonyms already handed out. The store enforces that user ids and pseudonyms are each unique.
+#An empty store (e.g. left by a run that failed before it wrote anything) is started afresh from the legacy dictionary,
+#just as a missing one is, so that nobody is given a new pseudonym because their old one was not imported.
+#The import is committed before anything else happens, so that it is never lost to a later failure.
+if identity_store.is_empty(args.dictionary):
+  legacy = os.path.splitext(args.dictionary)[0] + '.json'
+  if not args.import_dictionary and os.path.exists(legacy): args.import_dictionary = legacy
+elif args.import_dictionary:
+  raise Exception(f'Will not import {args.import_dictionary} into existing identity store {args.dictionary}')
+if args.import_dictionary:
+  print(f'Starting {args.dictionary} from {args.import_dictionary}')
+  identity_store.create_from_json(args.dictionary, args.import_dictionary)
+identities = identity_store.IdentityStore(args.dictionary)
 
-    #paranoia checks
-    if len(identities) != len(set(identities.keys())):   raise Exception('User names in args.dictionary are not unique')
-    if len(identities) != len(set(identities.values())): raise Exception('Pseudonames in args.dictionary are not unique')
-else:
-  identities = {}
-
-def pseudonymize(row):
-  def random_name():
-    failcount = 0
-    while failcount < 10:
-      #TODO: 6 digits provides enough unique strings for Engaging Crowds. Should really be calculated.
-      rnd = ''.join(secrets.choice(string.digits) for i in range(6))
-      if f'{prefix}{rnd}' in identities.values():
-        failcount += 1
+#Number of digits needed for pseudonyms for a population of the given size
+#We want the pseudonym space to be much bigger than the population, so that random draws rarely collide
+#(and so that the pseudonyms do not give away much about how many people we have seen). Never go below the
+#6 digits that earlier runs used, so that new pseudonyms look like the old ones.
+def pseudonym_width(population):
+  width = 6
+  while 10 ** width < population * 100:
+    width += 1
+  return width
+
+#Allocate pseudonyms for all of the given uids in one go, adding them to identities in a single batch
+#new_uids is a dict mapping each uid that does not yet have a pseudonym to its prefix ('name:' or 'anon:')
+#Returns a dict mapping each of the uids to its new pseudonym
+def allocate_pseudonyms(new_uids):
+  allocated = {}
+  if len(new_uids) == 0: return allocated
+  width = pseudonym_width(len(identities) + len(new_uids))
+  drawn = set()
+  pending = list(new_uids.items())
+  while len(pending):
+    candidates = [f'{prefix}{secrets.randbelow(10 ** width):0{width}d}' for _, prefix in pending]
+    taken = identities.taken(candidates)
+    collisions = []
+    for (uid, prefix), user_name in zip(pending, candidates):
+      if user_name in taken or user_name in drawn:
+        collisions.append((uid, prefix))
       else:
-        return rnd
-    raise Exception('10 failures to generate a unique pseudonym. Try increasing the number of characters in the pseudonyms.')
-
-  uid = row['user_id']
-  if np.isnan(uid):
-    #Anonymous user -- use the ip addr as the uid, so that all
-    #classifications from the apparent-same IP addr get the same pseudonym
-    uid = row['user_ip']
-    prefix = 'anon:'
-  else:
-    #Written out as a stringified int, so force what we read from the
-    #dataframe to the same format. Otherwise the keys will not match.
-    uid = str(int(uid))
-    prefix = 'name:'
-
-  if uid in identities:
-    user_name = identities[uid]
-    prefix = user_name[:5]
-    pseudonym = user_name[5:]
-  else:
-    pseudonym = random_name()
-    identities[uid] = f'{prefix}{pseudonym}'
-    user_name = identities[uid]
-
-  if prefix == 'name:':
-    return [user_name, pseudonym, '']
-  elif prefix == 'anon:':
-    return [user_name, '', pseudonym]
+        drawn.add(user_name)
+        allocated[uid] = user_name
+    pending = collisions #With the space at least 100x the population, each round should shrink this by ~99%
+  identities.add(allocated.items())
+  return allocated
+
+#Pseudonymise whole columns at once, rather than row by row
+#Takes a list of dataframes with user_name, user_id and user_ip columns and returns a matching list of dataframes
+#holding the replacement values for those columns. For each row, this is [user_name, pseudonym, ''] for a logged-in
+#user or [user_name, '', pseudonym] for an anonymous user, where user_name is the full prefixed pseudonym.
+#Every distinct uid across all of the dataframes is looked up (or allocated) in identities exactly once.
+def pseudonymize_columns(dfs):
+  with profiling.stage('pseudonymise', rows = sum(len(df) for df in dfs)):
+    uids = []
+    nameds = []
+    for df in dfs:
+      #Logged-in users are identified by their user id, written out as a stringified int so that the keys match
+      #what we read back from the dictionary. Anonymous users are identified by their ip addr, so that all
+      #classifications from the apparent-same IP addr get the same pseudonym.
+      named = df['user_id'].notna().to_numpy()
+      uid = df['user_ip'].to_numpy(dtype = object, copy = True)
+      uid[named] = df['user_id'][named].astype(np.int64).astype(str).to_numpy()
+      uids.append(uid)
+      nameds.append(named)
+    named = np.concatenate(nameds)
+    codes, uniques = pd.factorize(np.concatenate(uids))
+    if (codes == -1).any():
+      raise Exception('Classification with neither user_id nor user_ip')
+
+    #Allocate pseudonyms for everyone that we have not seen before, prefixed according to the first classification that they appear in
+    known = identities.lookup(uniques)
+    _, first_seen = np.unique(codes, return_index = True)
+    known.update(allocate_pseudonyms({uid: 'name:' if named[first_seen[i]] else 'anon:' for i, uid in enumerate(uniques) if not uid in known}))
+
+    user_names = np.array([known[uid] for uid in uniques], dtype = object)
+    prefixes = np.array([x[:5] for x in user_names], dtype = object)
+    pseudonyms = np.array([x[5:] for x in user_names], dtype = object)
+    bad = ~np.isin(prefixes, ['name:', 'anon:'])
+    if bad.any():
+      raise Exception(f'Unexpected prefix in {user_names[bad]}')
+    is_name = prefixes == 'name:'
+
+    results = []
+    start = 0
+    for df in dfs:
+      c = codes[start:start + len(df)]
+      start += len(df)
+      results.append(pd.DataFrame({
+        'user_name': user_names[c],
+        'user_id': np.where(is_name[c], pseudonyms[c], ''),
+        'user_ip': np.where(is_name[c], '', pseudonyms[c]),
+      }, index = df.index))
+    return results
+
+#Compile the paths of the JSON fields that we want to keep into a trie of lower-cased keys, so that each
+#JSON cell can be walked once for all of the fields. Inner nodes are dicts, leaves are the index of the
+#field in json_fields. Assume that '.' is a path separator.
+def compile_json_paths(json_fields):
+  trie = {}
+  for i, path in enumerate(json_fields):
+    node = trie
+    keys = path.lower().split('.')
+    for k in keys[:-1]:
+      node = node.setdefault(k, {})
+      if not isinstance(node, dict):
+        raise Exception(f'JSON field {path!r} runs through another JSON field')
+    if keys[-1] in node:
+      raise Exception(f'JSON field {path!r} duplicates or contains another JSON field')
+    node[keys[-1]] = i
+  return trie
+
+#Walk a single parsed JSON cell, matching keys case-insensitively, recording the value (and the spelling of the path)
+#of each field in the trie. Anything odd goes into problems as (kind, row, path) for the caller to report.
+def _walk_json(d, node, row, values, spellings, problems, spelling = ()):
+  found = set()
+  for k, v in d.items():
+    lk = k.lower()
+    if not lk in node: continue
+    if lk in found:
+      problems.append(('multicased', row, '.'.join(spelling + (lk,))))
+      continue
+    found.add(lk)
+    child = node[lk]
+    if isinstance(child, dict):
+      if v is None: continue #Leave everything below here as NaN
+      if not isinstance(v, dict):
+        problems.append(('missing', row, '.'.join(spelling + (lk,))))
+        continue
+      _walk_json(v, child, row, values, spellings, problems, spelling + (k,))
+    else:
+      values[child][row] = np.nan if v is None else v
+      spellings[child].add('.'.join(spelling + (k,)))
+  for lk in node.keys() - found:
+    if lk == '#priority' and any(k.lower() == 'priority' for k in d):
+      problems.append(('priority', row, '.'.join(spelling + (lk,)))) #Accept (but warn about) use of priority for #priority
+    else:
+      problems.append(('missing', row, '.'.join(spelling + (lk,))))
+
+#Parse and walk a list of JSON cells. This is the unit of work for the worker pool, so everything it needs comes in as arguments.
+#With check_column (the name of the JSON column), the extracted values are also checked against the parsed JSON here, so
+#that only the values and any mismatches (rather than the much bigger parsed JSON) have to come back from a worker.
+def _extract_json_chunk(trie, json_fields, json_parser, check_column, cells):
+  values = [[np.nan] * len(cells) for _ in json_fields]
+  spellings = [set() for _ in json_fields]
+  problems = []
+  parsed = []
+  for row, cell in enumerate(cells):
+    d = json_parser(cell)
+    if check_column: parsed.append(d)
+    _walk_json(d, trie, row, values, spellings, problems)
+  mismatches = []
+  if check_column and not any(kind != 'priority' for kind, _, _ in problems): #Anything else is reported by the caller
+    mismatches = json_mismatches(check_column, [x.lower() for x in json_fields], [pd.Series(v) for v in values], parsed)
+  return values, spellings, problems, mismatches
+
+#Pull just the json_fields out of df[json_column], without building a full normalized frame
+#Returns a dataframe of the fields (with lower-cased names, aligned to df's index)
+#Fields are matched case-insensitively. A missing '#priority' is allowed (and left empty) where 'priority' is present instead.
+#With check, every extracted value is also checked against the JSON (see check_json_fields).
+def extract_json_fields(df, json_column, json_fields, json_parser = json_loads, check = False):
+  trie = compile_json_paths(json_fields)
+  cells = df[json_column].tolist()
+  work = partial(_extract_json_chunk, trie, json_fields, json_parser, json_column if check else None)
+  if args.json_workers > 1 and len(cells) >= JSON_PARALLEL_MIN_ROWS:
+    chunk_size = -(-len(cells) // (args.json_workers * 4))
+    #fork, as this script is not safe to re-import in a spawned worker
+    with multiprocessing.get_context('fork').Pool(args.json_workers) as pool:
+      chunks = pool.map(work, [cells[i:i + chunk_size] for i in range(0, len(cells), chunk_size)])
   else:
-    raise Exception(f'{prefix} {user_name} {pseudonym}')
-
-#df must have a default index -- otherwise it will not align with the output of pd.json_normalize
-#json_fields must be the not-lower-case 'spelling' in cases where there are lower-case and not-lower-case spellings of the same field
-def expand_json(df, json_column, json_fields, prefix, json_parser = json.loads):
-  def check_metadata(row):
-    #Check that key in original JSON matches what is in the column -- but case-insensitively
-    #Also confirms that all of the expected metadata is actually in there
-    #Assume that '.' is a path separator
-
-    #Return a copy of a dict with all keys lower-cased
-    #Dictionaries are deep copied, but any other data structures contained in the dictionary are shallow-copied
-    #We only mutate the keys, so the original structure inside the DataFrame is unchanged
-    def lc_dict(d):
-      d = d.copy()
-      keys = list(d.keys())
-      for k in keys:
-        lk = k.lower()
-        if k != lk:
-          if lk in d:
-            raise Exception('Key collision when normalising JSON in DataFrame to lowercase')
-          d[lk] = d.pop(k)
-        if isinstance(d[lk], dict):
-          d[lk] = lc_dict(d[lk])
-      return d
-
-    normalized_json = lc_dict(row[json_column]) #The original JSON as a dict, but with the keys lower-cased
-    for path in json_fields:
-      d = normalized_json
-      for k in [x.lower() for x in path.split('.')]:
-        if not k in d:
-          if k == '#priority':
-            if 'priority' in d: #Accept (but warn about) use of priority for #priority
-              print(f'Allowing priority instead of #priority for subject {row.subject_ids}', file = sys.stderr)
-              d = None
-              break
-              #In all other cases, I'll get an exception, which'll make me aware of another metadata anomaly to handle
-        d = d[k]
+    chunk_size = len(cells)
+    chunks = [work(cells)]
+
+  values = [[] for _ in json_fields]
+  spellings = [set() for _ in json_fields]
+  problems = []
+  mismatches = []
+  for offset, (c_values, c_spellings, c_problems, c_mismatches) in zip(range(0, len(cells), max(chunk_size, 1)), chunks):
+    for i in range(len(json_fields)):
+      values[i].extend(c_values[i])
+      spellings[i] |= c_spellings[i]
+    problems.extend([(kind, row + offset, path) for kind, row, path in c_problems])
+    mismatches.extend(c_mismatches)
+
+  for kind, row, path in problems:
+    if kind == 'priority':
+      print(f'Allowing priority instead of #priority for subject {df.subject_ids.iloc[row]}', file = sys.stderr)
+  for kind, row, path in problems:
+    if kind == 'multicased':
+      raise Exception(f'Apparent multicased JSON field {path} does not align: subject {df.subject_ids.iloc[row]} has values in more than one spelling of the field.')
+    if kind == 'missing':
+      raise Exception(f'Expected JSON field {path} missing from col "{json_column}" for subject {df.subject_ids.iloc[row]}')
+
+  #Handle the JSON having been treated as case-insensitive
+  for json_field, field_spellings in zip(json_fields, spellings):
+    if len(field_spellings) > 1:
+      print(f'Fixing up apparent use of {" and ".join(sorted(field_spellings))} as {json_field.lower()}', file = sys.stderr)
+
+  if len(mismatches):
+    raise Exception('\n'.join(mismatches))
+
+  return pd.DataFrame({json_field.lower(): pd.Series(v, index = df.index) for json_field, v in zip(json_fields, values)}, index = df.index)
+
+#Check that the values in the extracted columns match what is in the original JSON -- but case-insensitively
+#Also confirms that all of the expected metadata is actually in there
+#Assume that '.' is a path separator
+#This deliberately does not share code with extract_json_fields, so that it gives an independent check
+#df must contain the lower-cased json_fields as columns, parsed is the parsed JSON for each row of df
+def check_json_fields(df, json_column, json_fields, parsed):
+  problems = json_mismatches(json_column, json_fields, [df[path] for path in json_fields], parsed)
+  if len(problems):
+    raise Exception('\n'.join(problems))
+
+#The guts of check_json_fields: a description of each value in columns (one per path in json_fields, aligned with parsed)
+#that does not match the JSON
+def json_mismatches(json_column, json_fields, columns, parsed):
+  #Look up k in d, treating the keys of d as lower-cased
+  def lc_get(d, k):
+    lc = {}
+    for key, value in d.items():
+      lk = key.lower()
+      if lk in lc:
+        raise Exception('Key collision when normalising JSON in DataFrame to lowercase')
+      lc[lk] = value
+    if not k in lc:
+      if k == '#priority' and 'priority' in lc: #Accept use of priority for #priority (extract_json_fields warns about it)
+        return None
+      #In all other cases, I'll get an exception, which'll make me aware of another metadata anomaly to handle
+    return lc[k]
+
+  problems = []
+  for path, actual in zip(json_fields, columns):
+    expected = []
+    for d in parsed:
+      for k in path.split('.'):
+        d = lc_get(d, k)
         if d is None:
           break
+      expected.append(d)
+    expected = pd.Series(expected, index = actual.index, dtype = object)
+    same = (expected.isna() & actual.isna()).to_numpy()
+    both = (expected.notna() & actual.notna()).to_numpy()
+    same[both] = expected.to_numpy()[both] == actual.to_numpy(dtype = object)[both]
+    for d, value in zip(expected[~same], actual[~same]):
+      problems.append(f'For path "{path}", the following should match:\n'
+                      f'"{d}" in JSON at col "{json_column}"\n'
+                      f'"{value}" in col "{path}"')
+  return problems
 
-      def errstring():
-        return (f'For path "{path}", the following should match:\n'
-                f'"{d}" in JSON at col "{json_column}"\n'
-                f'"{row[path]}" in col "{path}"')
-      if d is None:
-        if not np.isnan(row[path]):
-          raise Exception(errstring())
-      else:
-        if d != row[path]:
-          raise Exception(errstring())
+#Up to VALIDATE_SAMPLE_SIZE random rows from each workflow version in df
+def validation_sample(df):
+  rnd = pd.Series(np.random.default_rng().random(len(df)), index = df.index)
+  return df[rnd.groupby([df.workflow_id, df.workflow_version]).rank(method = 'first') <= VALIDATE_SAMPLE_SIZE]
 
-  df[json_column] = df[json_column].apply(json_parser)
-  jn = pd.json_normalize(df[json_column].tolist())#, meta = json_fields)[json_fields]
+#Replace df[json_column] with one column per entry in json_fields, named {prefix}.{lower-cased field name}
+def expand_json(df, json_column, json_fields, prefix, json_parser = json_loads):
+  with profiling.stage(f'expand_json {json_column}', rows = len(df)):
+    jn = extract_json_fields(df, json_column, json_fields, json_parser, check = args.validate == 'full')
+    json_fields = [x.lower() for x in json_fields]
 
-  #Handle the JSON having been treated as case-insensitive
-  for json_field in json_fields:
-    lower_field = json_field.lower()
-    insensitive_count = Counter([x.lower() for x in jn.columns])[lower_field]
-    if insensitive_count == 1:
-      continue
-    if insensitive_count != 2:
-      raise Exception(f'{lower_field}: {insensitive_count}') #Only wrote code to handle lowercase + one other version
-
-    #At this point we know that there are two case-variants of the same name. For the rest of this code to work,
-    #we need to know both 'spellings'. For now, just reqire that the passed-in name is the not-lower-case name
-    #TODO: An alternative to aborting in this case would be to just figure out what the non-lowercase variant is
-    if json_field == lower_field:
-      raise Exception(f'json_fields argument {json_field!r} must be the non-lower-case variant')
-
-    #Check that the nulls line up consistently with this being the same field with inconsistent case in name
-    if jn[[json_field, lower_field]].isnull().sum(axis = 1).ne(1).any():
-      bad = jn[[json_field, lower_field]].isnull().sum(axis = 1).ne(1)
-      raise Exception(f'Apparent multicased JSON field {json_field} does not align: some rows have values in both or neither spelling of the field.\n' + str(jn[bad][[json_field, lower_field]]))
-    print(f'Fixing up apparent use of both {json_field} and {lower_field}', file = sys.stderr)
-
-    jn[lower_field] = jn[lower_field].combine_first(jn[json_field])
-    jn = jn.drop(json_field, axis = 1)
-    assert not jn[lower_field].isnull().any(), jn[jn[lower_field].isnull()][lower_field]
-  jn = jn.rename({x: x.lower() for x in json_fields}, axis = 1)
-  json_fields =     [x.lower() for x in json_fields]
-
-  for x in json_fields:
-    if x in df.columns:
-      raise Exception(f'JSON field {x!r} already exists in dataframe columns')
-
-  df = df.join(jn[json_fields])
-  df.apply(check_metadata, axis = 'columns') #Check that the metadata looks right -- has caught real problems at least once
-  df = df.rename(columns = {x: f'{prefix}.{x}' for x in json_fields})
-  df = df.drop(json_column, axis = 'columns')
-  return df
+    for x in json_fields:
+      if x in df.columns:
+        raise Exception(f'JSON field {x!r} already exists in dataframe columns')
 
-#Read workflow's CSV file into a dataframe and do workflow-specific transformations
-def read_workflow(workflow):
-  print(workflow, config.WORKFLOW_NAMES[workflow])
-  csv_file = f'{args.exports}/{config.WORKFLOW_NAMES[workflow]}-classifications.csv'
-  df = pd.read_csv(csv_file, converters = { 'workflow_version': lambda x: str(x) })
-  if not len(df.workflow_id.unique()) == 1:
-    raise Exception(f'Too many workflow ids in {csv_file}')
-  if df.workflow_id.iloc[0] != workflow:
-    raise Exception(f'Expected workflow id {workflow} in CSV file {csv_file}. Got {df.workflow_id.iloc[0]}.')
+    df = df.join(jn[json_fields])
+    #Check that the metadata looks right -- has caught real problems at least once
+    #(With --validate=full, extract_json_fields has already checked every row)
+    if args.validate == 'sample':
+      sample = validation_sample(df)
+      check_json_fields(sample, json_column, json_fields, [json_parser(x) for x in sample[json_column]])
+    df = df.rename(columns = {x: f'{prefix}.{x}' for x in json_fields})
+    df = df.drop(json_column, axis = 'columns')
+    return df
+
+#Pull interesting bits of subject info out into their own fields
+def parse_subj_info(cell):
+  subj_info = json_loads(cell)
+
+  #Make sure that the data is shaped as we expect
+  if len(subj_info) != 1:
+    if len(subj_info > 1):
+      raise Exception(f'Encountered subject info for multiple subject ids: {subj_info.keys()}')
+    else: #0-length dictionary
+      raise Exception('Missing subject info')
+
+  #Remove the single top-level key (which is the subject id) and just return the info about this subject
+  #(See https://www.geeksforgeeks.org/python-get-the-first-key-in-dictionary/ for the next iter trick)
+  return subj_info[next(iter(subj_info))]
 
-  minimal_pseudonyms[workflow] = df.copy() #Store the original classification
+#Read a workflow's export, as a single dataframe or (with chunksize) as an iterator of dataframes of up to chunksize rows
+def export_file(workflow):
+  return f'{args.exports}/{config.WORKFLOW_NAMES[workflow]}-classifications.csv'
 
+def read_export(workflow, chunksize = None):
+  csv_file = export_file(workflow)
+  chunks = pd.read_csv(csv_file, converters = { 'workflow_version': lambda x: str(x) }, chunksize = chunksize)
+  if chunksize is None: chunks = [chunks]
+  for df in chunks:
+    if not len(df.workflow_id.unique()) <= 1:
+      raise Exception(f'Too many workflow ids in {csv_file}')
+    if len(df) and df.workflow_id.iloc[0] != workflow:
+      raise Exception(f'Expected workflow id {workflow} in CSV file {csv_file}. Got {df.workflow_id.iloc[0]}.')
+    yield df
+
+#Do workflow-specific transformations on (some of) a workflow's export
+def prepare_workflow(workflow, df):
   df = df[df['workflow_version'].isin(config.WORKFLOW_KEEPERS[workflow])]
-  df = df.reset_index(drop = True) #Reset the index so that we line up with the JSON expansion
+  df = df.reset_index(drop = True)
 
   df['START'] = config.WORKFLOW_STARTSTAMP[workflow]
   df['START'] = df['START'].astype(np.datetime64)
 
-  #Pull interesting bits of subject info out into their own fields
-  def parse_subj_info(cell):
-    subj_info = json.loads(cell)
-
-    #Make sure that the data is shaped as we expect
-    if len(subj_info) != 1:
-      if len(subj_info > 1):
-        raise Exception(f'Encountered subject info for multiple subject ids: {subj_info.keys()}')
-      else: #0-length dictionary
-        raise Exception('Missing subject info')
-
-    #Remove the single top-level key (which is the subject id) and just return the info about this subject
-    #(See https://www.geeksforgeeks.org/python-get-the-first-key-in-dictionary/ for the next iter trick)
-    return subj_info[next(iter(subj_info))]
   df = expand_json(df, 'subject_data', config.ALL_SUBJECT_KEEPERS + config.WORKFLOW_SUBJECT_KEEPERS[workflow], 'subj', parse_subj_info)
 
+  #Integer fields that some of main's rows go without are float in main's frame, so they are written as 3.0, not 3.
+  #Make them float whichever rows are in df, so that --chunksize and --incremental write them the same way.
+  for column in optional_subject_columns():
+    if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+      df[column] = df[column].astype(np.float64)
+
   return df
 
+#Read workflow's CSV file into a dataframe and do workflow-specific transformations
+def read_workflow(workflow):
+  with profiling.stage(f'read_workflow {workflow}') as s:
+    print(workflow, config.WORKFLOW_NAMES[workflow])
+    df, = read_export(workflow)
+    df = prepare_workflow(workflow, df)
+    s.rows = len(df)
+    return df
+
+#Index of the classification ids in the --exclusions file
+#An EXCLUSION_INDEX is used as it is. A CSV is read for its classification_id column, and the index is cached until the CSV changes.
+def read_exclusion_index(path):
+  if path.endswith('.npy'):
+    return np.load(path)
+
+  cache = f'{EXCLUSIONS_CACHE_DIR}/{util.fnam_norm(path)}'
+  meta = None
+  if os.path.exists(f'{cache}.json'):
+    with open(f'{cache}.json') as f:
+      meta = json.load(f)
+  signature = util.file_signature(path, meta)
+  if meta and meta['sha256'] == signature['sha256']:
+    index = np.load(f'{cache}.npy')
+  else:
+    print(f'Indexing {path}')
+    index = util.id_index(pd.read_csv(path, usecols = ['classification_id']).classification_id)
+    os.makedirs(EXCLUSIONS_CACHE_DIR, exist_ok = True)
+    np.save(f'{cache}.npy', index)
+  if signature != meta:
+    with open(f'{cache}.json', 'w') as f:
+      json.dump(signature, f, indent = 2)
+  return index
+
+#Index of the classification ids to exclude (e.g. because they were part of an earlier phase), or None if there are none
+def load_exclusions():
+  if not args.exclusions: return None
+  index = read_exclusion_index(args.exclusions)
+  overrides = util.id_index(args.exclusions_override)
+  assert util.index_contains(index, overrides).all() #verify that overrides are actually in the exclusions
+  return index[~util.index_contains(overrides, index)]
+
+def exclude(df, exclusion_index):
+  if exclusion_index is None: return df
+  df = df[~util.index_contains(exclusion_index, df['classification_id'].to_numpy())]
+  return df.reset_index(drop = True)
+
+#Write the index of the classification ids in the sharing/ outputs
+def write_exclusion_index(ids):
+  if args.exclusion_index:
+    np.save(EXCLUSION_INDEX, util.id_index(ids))
+
+#Replace the user fields with the pseudonym (as generated by pseudonymize_columns), drop other fields that we do not need and expand the metadata
+def finish_classifications(df, pseudonyms):
+  #Keep just the full pseudonym, and then drop the useless fields
+  df['pseudonym'] = pseudonyms['user_name']
+  df = df.drop(['user_name', 'user_id', 'user_ip'], axis = 'columns')
+
+  #Drop fields that we do not need at all
+  df = df.drop(['gold_standard', 'expert'], axis = 'columns')
+
+  #Expand out the interesting bits of the metadata, drop the rest
+  return expand_json(df, 'metadata', config.METADATA_KEEPERS, 'md')
+
+#The expanded metadata (md.* columns) of df, as returned by finish_classifications, indexed by classification_id
+#Later steps that work on the same classifications (e.g. write_minimal) look values up in here rather than parsing the metadata again
+def metadata_table(df):
+  md = df[['classification_id'] + [f'md.{x.lower()}' for x in config.METADATA_KEEPERS]]
+  md = md[~md.classification_id.duplicated()]
+  return md.set_index('classification_id')
+
+#The first subject for each date in the meetings workflow is the attendance page
+#Important to do this *before* we drop any rows! Otherwise the first page within a date group is not necessarily an attendance page.
+#FIXME: Read in the subjects file and use that to identify the attendance pages -- this won't break if we happen to start dropping rows earlier then here.
+#Returns the page number and subject id of the attendance page for each date. The subject_ids column is what analysis_classifications wants.
+def find_attendance_pages(df):
+  if not 18504 in args.workflows: #Meetings workflow not present (e.g. phase 2 config)
+    return pd.DataFrame(columns = ['subj.page', 'subject_ids'], index = pd.Index([], name = 'subj.date'))
+  return df[df.workflow_id == 18504].sort_values('subj.page')[['subj.date', 'subj.page', 'subject_ids']].groupby(['subj.date']).first()
+
+#Much the same as the data sharing platform output, but classifications outside of the relevant date range are dropped
+#And we make a fake workflow of the attendance branch of the meetings workflow
+def analysis_classifications(df, attendance_subjects):
+  df.loc[df.subject_ids.isin(attendance_subjects), ('workflow_id', 'workflow_name')] = (1, 'attendance')
+
+  df['md.started_at'] = util.parse_timestamps(df['md.started_at'], args.verify_dates)
+  df = df[df['md.started_at'] >= df['START']]
+  df = df.drop('START', axis = 'columns')
+
+  df['md.finished_at'] = util.parse_timestamps(df['md.finished_at'], args.verify_dates)
+  df = df[df['md.finished_at'] < np.datetime64(config.STOPSTAMP)]
+
+  return df.drop('annotations', axis = 'columns')
+
+def write_readme_all_classifications():
+  with open('README_all_classifications', 'w') as f:
+    f.write(config.readme_blurb(list(config.SUBJECTS.keys())))
+
+#Write out (some of) a workflow's minimally altered (pseudonymised) classifications
+#started_at comes from metadata (as made by metadata_table) where it can, so only classifications that did not make
+#it through to the other outputs (e.g. other workflow versions, or exclusions) have their metadata parsed here
+#This should be updated for STOPSTAMP, but I'm anyway not using it at the moment.
+def write_minimal(workflow, v, header = True, metadata = None):
+  if metadata is None:
+    started_at = pd.Series(np.nan, index = v.index, dtype = object)
+  else:
+    started_at = pd.Series(metadata['md.started_at'].reindex(v.classification_id).to_numpy(), index = v.index, dtype = object)
+  unparsed = started_at.isna()
+  started_at[unparsed] = v['metadata'][unparsed].map(lambda x: json_loads(x)['started_at'])
+  v = v[started_at >= config.WORKFLOW_STARTSTAMP[workflow]]
+  v.to_csv(f'secrets/{config.WORKFLOW_NAMES[workflow]}-classifications.csv', index = False, mode = 'w' if header else 'a', header = header)
+
+#Write out minimally altered versions of the original exports, pseudonymising as we go
+#This is a separate pass over the exports, a chunk at a time, so that we never have to hold
+#the raw exports in memory alongside the processed classifications
+def write_minimal_workflows(metadata):
+  for workflow in args.workflows:
+    with profiling.stage(f'write_minimal {workflow}', rows = 0) as s:
+      for i, raw in enumerate(read_export(workflow, args.chunksize or MINIMAL_CHUNKSIZE)):
+        pseudonymized, = pseudonymize_columns([raw])
+        raw[['user_name', 'user_id', 'user_ip']] = pseudonymized
+        write_minimal(workflow, raw, header = i == 0, metadata = metadata)
+        s.rows += len(raw)
+
+def write_identities():
+  identities.commit()
+  if args.export_dictionary:
+    identities.export_json(args.export_dictionary)
+
 def main():
   #Read in all of the CSVs with a generator expression, as suggested here:
   #https://stackoverflow.com/a/21232849
   df = pd.concat([read_workflow(x) for x in args.workflows], ignore_index = True)
 
   #dump any classifications we want to exclude (e.g. because they were part of an earlier phase)
-  if args.exclusions:
-    exclude_classifications = pd.read_csv(args.exclusions).classification_id
-    assert set(exclude_classifications[exclude_classifications.isin(args.exclusions_override)]) == set(args.exclusions_override) #verify that overrides are actually in the exclusions
-    exclude_classifications = exclude_classifications[~exclude_classifications.isin(args.exclusions_override)]
-    df = df[~df['classification_id'].isin(exclude_classifications)]
-    df = df.reset_index(drop = True) #Reset the index so that we line up with the JSON expansion
+  df = exclude(df, load_exclusions())
 
   print('Pseudonymising')
-  #Pseudonymise the individual files, building pseudonyms for everyone who has ever classified as a side effect
-  for v in minimal_pseudonyms.values():
-    #The assignment to v here has the potential for a SettingWithCopy bug
-    #(re last bit of https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#why-does-assignment-fail-when-using-chained-indexing)
-    #The failure mode would be that the fields do not get updated with their anonymized forms
-    #By inspection on latest run, this appears not to be triggering the bug. Hopefully the behaviour is consistent, given that the types of these columns will be consistent.
-    #(These are also not files that we put on the data sharing platform, and it seems unlikely that I would not have noticed this failing during user analysis)
-    v[['user_name', 'user_id', 'user_ip']] = v[['user_name', 'user_id', 'user_ip']].apply(pseudonymize, axis = 'columns', result_type = 'expand')
-
-  #Pseudonymize using the previously-generated pseuondyms, and then drop the useless field
-  df['pseudonym'] = df[['user_name', 'user_id', 'user_ip']].apply(pseudonymize, axis = 'columns', result_type = 'expand').iloc[:,0]
-  df = df.drop(['user_name', 'user_id', 'user_ip'], axis = 'columns')
-
-  #Drop fields that we do not need at all
-  df = df.drop(['gold_standard', 'expert'], axis = 'columns')
+  df_pseudonyms, = pseudonymize_columns([df])
 
   print('Expanding metadata')
-  #Expand out the interesting bits of the metadata, drop the rest
-  df = expand_json(df, 'metadata', config.METADATA_KEEPERS, 'md')
+  df = finish_classifications(df, df_pseudonyms)
+  metadata = metadata_table(df)
 
   #Output data for the data sharing platform
   print('Generating per-project outputs for data sharing platform')
   os.makedirs('sharing', exist_ok = True)
   make_shareables(df.copy())
+  write_exclusion_index(df.classification_id)
 
   #Output data for analysis
-  #Much the same as the data sharing platform output, but everything goes into a single file and classifications outside of the relevant date range are dropped
-  #And we make a fake workflow of the attendance branch of the meetings workflow
-  #Important to do this *before* we drop any rows! Otherwise the first page within a date group is not necessarily an attendance page.
-  #FIXME: Read in the subjects file and use that to identify the attendance pages -- this won't break if we happen to start dropping rows earlier then here.
+  #Everything goes into a single file
+  attendance = None
   if args.all_classifications:
     print('Generating all_classifications.csv for analysis')
-    attendance_subjects = df[df.workflow_id == 18504].sort_values('subj.page')[['subj.date', 'subject_ids']].groupby(['subj.date']).first().subject_ids
-    df.loc[df.subject_ids.isin(attendance_subjects), ('workflow_id', 'workflow_name')] = (1, 'attendance')
+    with profiling.stage('all_classifications', rows = len(df)):
+      attendance = find_attendance_pages(df)
+      df = analysis_classifications(df, attendance.subject_ids)
+      write_readme_all_classifications()
+      df.to_csv('all_classifications.csv', index = False, date_format = DATE_FORMAT)
 
-    df['md.started_at'] = df['md.started_at'].astype(np.datetime64)
-    df = df[df['md.started_at'] >= df['START']]
-    df = df.drop('START', axis = 'columns')
+  #Pseudonymise the individual files, building pseudonyms for everyone who has ever classified as a side effect
+  print('Writing minimally altered classifications')
+  write_minimal_workflows(metadata)
+
+  write_identities()
+  return attendance
+
+#The subj.* columns of all of the workflows, in the order that main's frame has them
+def subject_columns():
+  columns = {}
+  for workflow in args.workflows:
+    for field in config.ALL_SUBJECT_KEEPERS + config.WORKFLOW_SUBJECT_KEEPERS[workflow]:
+      columns[f'subj.{field.lower()}'] = True
+  return list(columns)
+
+#The subj.* columns that some of the run's rows have no value for: those that not every workflow keeps, and #priority,
+#which a subject can give as priority instead
+def optional_subject_columns():
+  kept = [{f'subj.{field.lower()}' for field in config.ALL_SUBJECT_KEEPERS + config.WORKFLOW_SUBJECT_KEEPERS[workflow]} for workflow in args.workflows]
+  return (set.union(*kept) - set.intersection(*kept)) | {'subj.#priority'}
+
+#As main, but reading each export in chunks of args.chunksize rows and taking each chunk all the way through to the outputs
+#The only state kept across chunks is the identity dictionary, the exclusions and the attendance subjects
+#Outputs should match main's.
+def main_chunked():
+  exclude_classifications = load_exclusions()
+
+  #The attendance subjects are the one thing that has to be known before we can write out any of the meetings classifications
+  attendance = None
+  if args.all_classifications:
+    if 18504 in args.workflows:
+      print('Finding attendance subjects')
+      pages = [exclude(prepare_workflow(18504, raw), exclude_classifications)[['workflow_id', 'subj.date', 'subj.page', 'subject_ids']] for raw in read_export(18504, args.chunksize)]
+      attendance = find_attendance_pages(pd.concat(pages, ignore_index = True))
+    else:
+      attendance = find_attendance_pages(None)
+
+  os.makedirs('sharing', exist_ok = True)
+  with tempfile.TemporaryDirectory(dir = 'secrets') as tmpdir:
+    shareables = {}
+    shared_ids = []
+    all_classifications = util.ChunkedCSV(tmpdir, group = subject_columns(), date_format = DATE_FORMAT)
+    subjects = (None, None)
+    for workflow in args.workflows:
+      print(workflow, config.WORKFLOW_NAMES[workflow])
+      project = next(p for p, wids in config.PROJECTS.items() if workflow in wids)
+      if subjects[0] != project:
+        subjects = (project, read_subjects(project))
+      if not project in shareables:
+        shareables[project] = util.ChunkedCSV(tmpdir, drop_empty = True, group = subject_columns(), date_format = DATE_FORMAT)
+
+      for i, raw in enumerate(read_export(workflow, args.chunksize)):
+        df = exclude(prepare_workflow(workflow, raw), exclude_classifications)
+        raw_pseudonyms, df_pseudonyms = pseudonymize_columns([raw, df])
+        raw[['user_name', 'user_id', 'user_ip']] = raw_pseudonyms
+        if len(df):
+          shared_ids.append(df.classification_id.to_numpy())
+          df = finish_classifications(df, df_pseudonyms)
+        write_minimal(workflow, raw, header = i == 0, metadata = metadata_table(df) if len(df) else None)
+        del raw
+
+        if len(df) == 0: continue
+        shareables[project].write(locate_subjects(project, df.drop('START', axis = 'columns'), *subjects[1]))
+        if args.all_classifications:
+          all_classifications.write(analysis_classifications(df, attendance.subject_ids))
+
+    print('Generating per-project outputs for data sharing platform')
+    for project, shareable in shareables.items():
+      print(f'  {project}')
+      archive_project(project, shareable.copy_to)
+    write_exclusion_index(np.concatenate(shared_ids) if len(shared_ids) else [])
+
+    if args.all_classifications:
+      print('Generating all_classifications.csv for analysis')
+      write_readme_all_classifications()
+      all_classifications.close('all_classifications.csv')
+
+  write_identities()
+  return attendance
+
+#Check that main writes exactly what main_chunked has just written, by putting main_chunked's outputs to one side,
+#running main, and comparing the two sets of outputs
+def verify_chunked():
+  print('Checking the chunked outputs against an unchunked run')
+  outputs = [f'secrets/{config.WORKFLOW_NAMES[w]}-classifications.csv' for w in args.workflows]
+  outputs += [f'sharing/{util.fnam_norm(p)}.{ext}' for p in config.PROJECTS for ext in ('zip', 'tar.xz')]
+  outputs += ['all_classifications.csv', EXCLUSION_INDEX]
+  with tempfile.TemporaryDirectory(dir = 'secrets') as tmpdir:
+    chunked = {}
+    for path in outputs:
+      if os.path.exists(path):
+        chunked[path] = f'{tmpdir}/{path.replace("/", "_")}'
+        os.replace(path, chunked[path])
+    main()
+    different = [path for path in chunked if not (os.path.exists(path) and filecmp.cmp(path, chunked[path], shallow = False))]
+  if len(different):
+    raise Exception(f'Chunked and unchunked runs give different {", ".join(different)}')
+  print('Chunked and unchunked outputs are the same')
+
+#Raised by main_incremental when the outputs cannot just be appended to, and so have to be rebuilt from scratch
+class RebuildNeeded(Exception):
+  pass
+
+#Everything other than the exports that determines what goes into the outputs
+#If any of this changes between incremental runs, then the existing outputs are no good and everything has to be rebuilt
+def run_fingerprint():
+  return {
+    'code': util.file_hash(__file__),
+    'config': util.file_hash(config.__file__),
+    'keepers': {str(k): list(v) for k, v in config.WORKFLOW_KEEPERS.items()},
+    'workflows': args.workflows,
+    'all_classifications': args.all_classifications,
+    'exclusions': args.exclusions and util.file_hash(args.exclusions),
+    'exclusions_override': sorted(args.exclusions_override),
+    'exclusion_index': args.exclusion_index,
+  }
 
-    df['md.finished_at'] = df['md.finished_at'].astype(np.datetime64)
-    df = df[df['md.finished_at'] < np.datetime64(config.STOPSTAMP)]
+def read_watermarks():
+  if not os.path.exists(WATERMARKS): return None
+  with open(WATERMARKS) as f:
+    state = json.load(f)
+  if state['version'] != WATERMARKS_VERSION: return None
+  return state
 
-    df = df.drop('annotations', axis = 'columns')
+#Digest of the rows of a workflow's export with classification ids up to watermark (or of all of them, if watermark is None),
+#so that an incremental run can tell whether any of the classifications that an earlier run processed have since been
+#changed, added or taken away. Rows are taken as the strings in the CSV, in classification id order.
+#Returns the digest, the highest classification id in the export and the number of rows above the watermark.
+def export_digest(workflow, watermark = None):
+  ids = []
+  hashes = []
+  for chunk in pd.read_csv(export_file(workflow), dtype = str, keep_default_na = False, chunksize = MINIMAL_CHUNKSIZE):
+    chunk_ids = chunk.classification_id.astype(np.int64).to_numpy()
+    processed = np.ones(len(chunk), dtype = bool) if watermark is None else chunk_ids <= watermark
+    ids.append(chunk_ids)
+    hashes.append(pd.util.hash_pandas_object(chunk[processed], index = False).to_numpy())
+  ids = np.concatenate(ids) if len(ids) else np.zeros(0, dtype = np.int64)
+  hashes = np.concatenate(hashes) if len(hashes) else np.zeros(0, dtype = np.uint64)
+  processed = ids if watermark is None else ids[ids <= watermark]
+  order = np.argsort(processed, kind = 'stable')
+  h = hashlib.sha256()
+  h.update(processed[order].tobytes())
+  h.update(hashes[order].tobytes())
+  return h.hexdigest(), (int(ids.max()) if len(ids) else 0), len(ids) - len(processed)
 
-    with open('README_all_classifications', 'w') as f:
-      f.write(config.readme_blurb([config.SUBJECTS.keys()]))
-    df.to_csv('all_classifications.csv', index = False, date_format='%Y-%m-%dT%H:%M:%S.%fZ%z')
+#Record, for each export, its signature, the highest classification id in it and a digest of its rows, so that the
+#next incremental run knows what is new and can check that nothing else has changed
+#attendance is the attendance pages for the run, as returned by main
+#previous is the state written by an earlier run, if any. Its watermark and digest for an export that has not changed
+#since are used as they are, so that only exports that have changed are read.
+def write_watermarks(fingerprint, attendance, previous = None):
+  workflows = {}
+  for workflow in args.workflows:
+    mark = previous and previous['workflows'].get(str(workflow))
+    signature = util.file_signature(export_file(workflow), mark and mark['export'])
+    if mark and signature['sha256'] == mark['export']['sha256']:
+      digest, watermark = mark['digest'], mark['classification_id']
+    else:
+      digest, watermark, _ = export_digest(workflow)
+    workflows[str(workflow)] = {
+      'export': signature,
+      'classification_id': watermark,
+      'digest': digest,
+    }
+  state = {
+    'version': WATERMARKS_VERSION,
+    'fingerprint': fingerprint,
+    'workflows': workflows,
+    'attendance': None if attendance is None else attendance.reset_index()[['subj.date', 'subj.page', 'subject_ids']].values.tolist(),
+  }
+  with open(WATERMARKS, 'w') as f:
+    json.dump(state, f, indent = 2)
 
-  #paranoia checks
-  if len(identities) != len(set(identities.keys())):   raise Exception('User names in args.dictionary are not unique')
-  if len(identities) != len(set(identities.values())): raise Exception('Pseudonames in args.dictionary are not unique')
-  with open(args.dictionary, 'w') as f:
-    json.dump(identities, f, indent = 2, sort_keys = True)
+#Reorder df's columns to match the header of a CSV written by an earlier run, so that df can be appended to it
+#Columns that the CSV does not have are dropped, so long as they are empty in df
+def align_to_header(df, header, what):
+  filled = [c for c in df.columns if not c in header and df[c].notna().any()]
+  if len(filled):
+    raise RebuildNeeded(f'new classifications have values for {", ".join(filled)}, which {what} does not have')
+  return df.reindex(columns = header)
 
-  #This should be updated for STOPSTAMP, but I'm anyway not using it at the moment.
-  for k, v in minimal_pseudonyms.items():
-    v['KEEP'] = v['metadata'].apply(lambda x: json.loads(x)['started_at'] >= config.WORKFLOW_STARTSTAMP[k])
-    v = v[v['KEEP']]
-    v = v.drop('KEEP', axis = 'columns')
-    v.to_csv(f'secrets/{config.WORKFLOW_NAMES[k]}-classifications.csv', index = False)
+def csv_header(f):
+  return next(csv.reader(io.TextIOWrapper(f, encoding = 'utf-8', newline = '')))
 
-main()
+#As main, but only for the classifications added to the exports since the run that wrote state, appending them to that run's outputs
+#Exports are assumed to only ever gain classifications, with higher classification ids than any already in there.
+#Raises RebuildNeeded before writing anything if this does not hold, or if anything else that goes into the outputs has changed.
+#Subject locations of classifications from earlier runs are not revisited, even if the subjects exports have changed.
+#Outputs hold the same rows as a full rebuild would, but with each run's new rows after the earlier ones rather than grouped
+#by workflow.
+def main_incremental(state, fingerprint):
+  if state is None:
+    raise RebuildNeeded(f'no usable {WATERMARKS}')
+  changed = [k for k in fingerprint if fingerprint[k] != state['fingerprint'].get(k)]
+  if len(changed):
+    raise RebuildNeeded(f'{", ".join(changed)} changed since the last run')
+  expected = [f'secrets/{config.WORKFLOW_NAMES[w]}-classifications.csv' for w in args.workflows]
+  expected += [f'sharing/{util.fnam_norm(p)}.zip' for p in config.PROJECTS]
+  if args.all_classifications: expected.append('all_classifications.csv')
+  if args.exclusion_index: expected.append(EXCLUSION_INDEX)
+  missing = [x for x in expected if not os.path.exists(x)]
+  if len(missing):
+    raise RebuildNeeded(f'missing output {", ".join(missing)}')
+
+  #Find out which exports have new classifications, checking that the ones that we have already seen are still there
+  watermarks = {}
+  for workflow in args.workflows:
+    csv_file = export_file(workflow)
+    mark = state['workflows'][str(workflow)]
+    if util.file_signature(csv_file, mark['export'])['sha256'] == mark['export']['sha256']: continue
+    digest, _, new = export_digest(workflow, mark['classification_id'])
+    if digest != mark['digest']:
+      raise RebuildNeeded(f'classifications already processed have changed in {csv_file}')
+    if new:
+      watermarks[workflow] = mark['classification_id']
+  if len(watermarks) == 0:
+    print('No new classifications')
+    return None if state['attendance'] is None else pd.DataFrame(state['attendance'], columns = ['subj.date', 'subj.page', 'subject_ids']).set_index('subj.date')
+
+  raws = {}
+  for workflow, watermark in watermarks.items():
+    print(workflow, config.WORKFLOW_NAMES[workflow])
+    raws[workflow] = pd.concat([raw[raw.classification_id > watermark] for raw in read_export(workflow, args.chunksize or MINIMAL_CHUNKSIZE)], ignore_index = True)
+  df = pd.concat([prepare_workflow(workflow, raw) for workflow, raw in raws.items()], ignore_index = True)
+  df = exclude(df, load_exclusions())
+
+  print('Pseudonymising')
+  *raw_pseudonyms, df_pseudonyms = pseudonymize_columns(list(raws.values()) + [df])
+  for raw, pseudonymized in zip(raws.values(), raw_pseudonyms):
+    raw[['user_name', 'user_id', 'user_ip']] = pseudonymized
+
+  #Work out everything that is to be appended before writing any of it, so that we can still fall back to a rebuild
+  shareables = {}
+  attendance = None
+  metadata = None
+  if len(df):
+    print('Expanding metadata')
+    df = finish_classifications(df, df_pseudonyms)
+    metadata = metadata_table(df)
+
+    for project, wids in config.PROJECTS.items():
+      proj_df = df[df.workflow_id.isin(wids)]
+      if len(proj_df) == 0: continue
+      proj_df = locate_subjects(project, proj_df.drop('START', axis = 'columns'), *read_subjects(project))
+      archive = f'sharing/{util.fnam_norm(project)}.zip'
+      member = f'{util.fnam_norm(project)}_data/classifications.csv'
+      with zipfile.ZipFile(archive) as zf, zf.open(member) as f:
+        proj_df = align_to_header(proj_df, csv_header(f), archive)
+      shareables[project] = (archive, member, proj_df)
+
+    if args.all_classifications:
+      #New classifications must not change which page is the attendance page for any date that we have already seen
+      previous = pd.DataFrame(state['attendance'], columns = ['subj.date', 'subj.page', 'subject_ids'])
+      attendance = find_attendance_pages(pd.concat([previous.assign(workflow_id = 18504), df], ignore_index = True))
+      if (attendance.subject_ids.reindex(previous['subj.date']).to_numpy() != previous.subject_ids.to_numpy()).any():
+        raise RebuildNeeded('new classifications change the attendance pages')
+      df = analysis_classifications(df, attendance.subject_ids)
+      df = align_to_header(df, pd.read_csv('all_classifications.csv', nrows = 0).columns, 'all_classifications.csv')
+
+  print('Appending minimally altered classifications')
+  for workflow, raw in raws.items():
+    write_minimal(workflow, raw, header = False, metadata = metadata)
+
+  print('Appending to per-project outputs for data sharing platform')
+  for project, (archive, member, proj_df) in shareables.items():
+    print(f'  {project}')
+    archive_project(project, util.zip_member_source(archive, member, util.csv_source(proj_df, index = False, header = False, date_format = DATE_FORMAT)))
+
+  if len(shareables) and args.exclusion_index:
+    write_exclusion_index(np.concatenate([np.load(EXCLUSION_INDEX)] + [proj_df.classification_id.to_numpy() for _, _, proj_df in shareables.values()]))
+
+  if attendance is not None:
+    print('Appending to all_classifications.csv')
+    df.to_csv('all_classifications.csv', index = False, header = False, mode = 'a', date_format = DATE_FORMAT)
+  elif args.all_classifications:
+    attendance = pd.DataFrame(state['attendance'], columns = ['subj.date', 'subj.page', 'subject_ids']).set_index('subj.date')
+
+  write_identities()
+  return attendance
+
+if args.incremental:
+  fingerprint = run_fingerprint()
+  state = read_watermarks()
+  #Until this run finishes, the outputs do not match any watermarks
+  if os.path.exists(WATERMARKS): os.unlink(WATERMARKS)
+  try:
+    attendance = main_incremental(state, fingerprint)
+  except RebuildNeeded as e:
+    print(f'Rebuilding all outputs: {e}')
+    attendance = main_chunked() if args.chunksize else main()
+  #The digests in state depend only on the exports, so they are still good for unchanged exports after a rebuild
+  write_watermarks(fingerprint, attendance, state)
+else:
+  #A full run leaves nothing for a later incremental run to build on
+  if os.path.exists(WATERMARKS): os.unlink(WATERMARKS)
+  if args.chunksize:
+    main_chunked()
+    if args.verify_chunked: verify_chunked()
+  else:
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import traceback
+
+import kaleido
+import plotly
+import plotly.io as pio
+from plotly.utils import PlotlyJSONEncoder
+
+import profiling
+
+_fork = multiprocessing.get_context('fork')
+
+#The Renderer that write_images submits to, while one is open
+RENDERER = None
+#The ImageCache that write_images takes images from and puts them into, if any
+CACHE = None
+
+#Write static images (svg, png...: the format comes from each path's extension) of plotly figure fig
+#Images that are in the CACHE are linked from there. If a Renderer is open, this just queues the figure for it and returns.
+#Otherwise, the images are written there and then.
+def write_images(fig, paths, width, height):
+  key = None
+  if CACHE:
+    key = CACHE.key(fig, width, height)
+    paths = [path for path in paths if not CACHE.fetch(key, path)]
+    CACHE.count(paths)
+    if not paths: return
+  if RENDERER: RENDERER.submit(fig, paths, width, height, key)
+  else:
+    for path in paths:
+      with profiling.stage(f'render {path}'):
+        fig.write_image(path, width = width, height = height)
+      if key: CACHE.store(key, path)
+
+#Store of static chart images, addressed by a hash of everything that goes into them: the figure (which has the chart's
+#data in it, as well as its layout and title), the image size and format, and the versions of plotly and kaleido that
+#draw it. It lives outside of the per-revision output directories, so a chart that comes out the same as in an earlier run
+#(of any revision) is hard linked (or copied, where that is not possible) from there rather than drawn again.
+#
+#Strings in volatile (the git condition that goes into the chart titles) are left out of the hash, so that committing or
+#editing code that does not change the chart does not mean drawing it again. An image that is reused does still have
+#the git condition of the run that drew it in its title.
+#
+#The counts of charts reused and rebuilt are shared with processes forked from this one.
+class ImageCache(object):
+  VERSION = 1 #Bump this to stop using images drawn by earlier versions of this code
+
+  def __init__(self, directory, volatile = ()):
+    self.directory = directory
+    self.volatile = []
+    for text in volatile:
+      for form in text, repr(text)[1:-1]: #As it is, and as it is in a repr of a list containing it
+        self.volatile.append(json.dumps(form, cls = PlotlyJSONEncoder)[1:-1])
+    self.reused = _fork.Value('Q', 0)
+    self.rebuilt = _fork.Value('Q', 0)
+    os.makedirs(directory, exist_ok = True)
+
+  def key(self, fig, width, height):
+    spec = pio.to_json(fig, validate = False, engine = 'json')
+    for text in self.volatile:
+      spec = spec.replace(text, '')
+    h = hashlib.sha256()
+    h.update(json.dumps([self.VERSION, plotly.__version__, kaleido.__version__, width, height]).encode())
+    h.update(spec.encode())
+    return h.hexdigest()
+
+  def _path(self, key, path):
+    return os.path.join(self.directory, key + os.path.splitext(path)[1])
+
+  #Put the cached image with this key, in the format of path, at path. False if there is no such image.
+  def fetch(self, key, path):
+    cached = self._path(key, path)
+    if not os.path.exists(cached): return False
+    _link(cached, path)
+    return True
+
+  #Add the image at path to the cache, under key
+  def store(self, key, path):
+    cached = self._path(key, path)
+    tmp = f'{cached}.{os.getpid()}.tmp'
+    _link(path, tmp)
+    os.replace(tmp, cached)
+
+  #Count a chart as rebuilt if any of its images had to be drawn, else as reused
+  def count(self, missing):
+    counter = self.rebuilt if missing else self.reused
+    with counter.get_lock():
+      counter.value += 1
+
+  def report(self):
+    return f'{self.reused.value} charts reused from {self.directory}, {self.rebuilt.value} rebuilt'
+
+def _link(src, dst):
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+#Pool of worker processes that write static images of plotly figures.
+#Static export goes through kaleido, which runs a headless browser. Each worker starts its own kaleido when it starts
+#(so that it is warm by the time that the first figure arrives) and keeps it for the whole run, rather than each
+#process that draws charts starting its own.
+#
+#The workers are only started when the first figure is submitted, so a run that takes every image from the CACHE never
+#starts any. They are started by the process that opened the Renderer. A forked process (e.g. a jobs.Pool task) that
+#submits a figure before then asks for them through wanted(), which jobs.Pool waits on along with its tasks.
+#
+#Figures are queued with a snapshot of their current state, so a figure can be changed and queued again. All of the
+#images of one figure go to one worker as a batch. Submissions can come from any process forked from the one that opened
+#the Renderer, so long as they finish before it is closed.
+#
+#On leaving the with block, we wait for the queue to drain. Every chart that could not be written is reported, and then
+#an exception is raised if there were any.
+class Renderer(object):
+  def __init__(self, workers):
+    if workers < 1: raise ValueError(f'Need at least one renderer, not {workers}')
+    self.queue = _fork.Queue()
+    self.results = _fork.Queue()
+    self.submitted = _fork.Value('Q', 0) #Shared with forked processes, so that we know how many results to wait for
+    self.workers = [_fork.Process(target = self._work, daemon = True) for _ in range(workers)]
+    self.owner = os.getpid()
+    self.started = False
+    self.asked = False #Whether this (forked) process has asked for the workers to be started
+    self.want_reader, self.want_writer = _fork.Pipe(duplex = False)
+
+  def __enter__(self):
+    global RENDERER
+    RENDERER = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    global RENDERER
+    RENDERER = None
+    if exc_type is not None:
+      if self.started:
+        for worker in self.workers: worker.kill()
+      return
+    if self.submitted.value: self.start()
+    failures = self._drain()
+    if self.started:
+      for worker in self.workers: self.queue.put(None)
+      for worker in self.workers: worker.join()
+    if failures:
+      for path, error in failures:
+        print(f'Failed to write {path}:\n{error}', file = sys.stderr)
+      raise Exception(f'Failed to write {len(failures)} chart image(s): {", ".join(path for path, _ in failures)}')
+
+  #Start the workers, if they have not been already. Only for the process that opened the Renderer.
+  def start(self):
+    if self.started: return
+    for worker in self.workers: worker.start()
+    self.started = True
+
+  #A connection that becomes ready when a forked process wants the workers started, or None if they have been
+  def wanted(self):
+    return None if self.started else self.want_reader
+
+  #key is the figure's key in the CACHE, if there is one
+  def submit(self, fig, paths, width, height, key = None):
+    if os.getpid() == self.owner: self.start()
+    elif not (self.started or self.asked):
+      self.want_writer.send_bytes(b'')
+      self.asked = True
+    with self.submitted.get_lock():
+      self.submitted.value += 1
+    self.queue.put((fig.to_dict(), paths, width, height, key))
+
+  def _drain(self):
+    received = 0
+    failures = []
+    while received < self.submitted.value:
+      try:
+        failures += self.results.get(timeout = 10)
+        received += 1
+      except queue.Empty:
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if dead: raise Exception(f'Renderer process died (exit code {dead[0].exitcode}) with {self.submitted.value - received} figure(s) outstanding')
+    return failures
+
+  def _work(self):
+    try:
+      pio.to_image({'data': [], 'layout': {}}, format = 'png', width = 10, height = 10) #Start kaleido
+    except Exception:
+      pass #If it really does not work, that will be reported for each chart
+    while True:
+      job = self.queue.get()
+      if job is None: break
+      fig, paths, width, height, key = job
+      failures = []
+      for path in paths:
+        try:
+          with profiling.stage(f'render {path}'):
+            pio.write_image(fig, path, width = width, height = height, validate = False) #Validated when it was queued
+          if key: CACHE.store(key, path)
+        except Exception:
+          failures.append((path, traceback.format_exc()))
+      self.results.put(failures)
@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 import tempfile
 import os
-from shutil import copy, copy2, copytree, make_archive, ignore_patterns
-from multiprocessing import Process
 import filecmp
 import subprocess
 import sys
@@ -11,11 +9,6 @@ import util as u
 
 os.makedirs('sharing', exist_ok = True)
 with tempfile.TemporaryDirectory(dir = './secrets') as tmpdir:
-  inner_dir = f'{tmpdir}/data_analysis'
-  os.mkdir(inner_dir)
-  copy('all_classifications.csv', inner_dir)
-  copy('README_all_classifications', f'{inner_dir}/README.txt')
-
   #Confirm that the supplied data matches the data used for analysis, modulo expected changes
   #At time of writing, this is just that we've added a couple of subject fields in the final all_classifications -- no actual data has changed
   with open('all_classifications.csv', 'r') as infile:
@@ -60,9 +53,7 @@ git stash && git checkout {u.git_report_final_deps()} && cp requirements.txt sec
   os.remove(f'{tmpdir}/csv.tmp')
   os.remove(f'{tmpdir}/freeze.tmp')
 
-  procs = []
-  for ar_format in ('zip', 'xztar'):
-    p = Process(target = make_archive, args = ('sharing/data_analysis', ar_format, tmpdir))
-    p.start()
-    procs.append(p)
-  for p in procs: p.join()
+u.write_archives('sharing/data_analysis', [
+  ('data_analysis/all_classifications.csv', u.file_source('all_classifications.csv')),
+  ('data_analysis/README.txt', u.file_source('README_all_classifications')),
+])
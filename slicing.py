@@ -0,0 +1,39 @@
+import data as d
+
+import numpy as np
+
+#Row positions of each workflow, project and workflow type in the prepared frame, worked out once so that the analyses
+#can slice them out without each scanning the whole workflow_id column for every slice.
+#Positions are kept in frame order, so a slice has the same rows in the same order as the equivalent
+#df[df.workflow_id.isin(wids)]. Because they are positions, they apply equally to any frame that has the same rows in the
+#same order as the one that the index was built from, such as a projection of it (pass the frame as df).
+class SliceIndex(object):
+  def __init__(self, df):
+    self.df = df
+    wids = df.workflow_id.to_numpy()
+    order = np.argsort(wids, kind = 'stable') #Grouped by workflow, in frame order within each workflow
+    present, starts = np.unique(wids[order], return_index = True)
+    ends = np.append(starts[1:], len(order))
+    self.workflows = {int(wid): order[start:end] for wid, start, end in zip(present, starts, ends)}
+    self.projects = {project: self._union(wids) for project, wids in d.PROJECTS.items()}
+    self.types = {w_type: self._union(wids) for w_type, wids in d.WORKFLOW_TYPES_BACKMAP.items()}
+
+  def _union(self, wids):
+    return np.sort(np.concatenate([self.workflows.get(wid, np.empty(0, dtype = np.intp)) for wid in wids]))
+
+  def _take(self, positions, df):
+    if df is None: df = self.df
+    if len(df) != len(self.df): raise Exception(f'Slice index is for a frame of {len(self.df)} rows, not {len(df)}')
+    return df.iloc[positions]
+
+  #Rows of df (by default, the frame that the index was built from) from workflow wid
+  def workflow(self, wid, df = None):
+    return self._take(self.workflows.get(wid, np.empty(0, dtype = np.intp)), df)
+
+  #Rows of df from the workflows in project
+  def project(self, project, df = None):
+    return self._take(self.projects[project], df)
+
+  #Rows of df from the workflows of type w_type
+  def workflow_type(self, w_type, df = None):
+    return self._take(self.types[w_type], df)
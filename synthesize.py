@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+#Make synthetic Zooniverse exports (<workflow>-classifications.csv and <project>-subjects.csv files), shaped like the real
+#exports that a config (data.py or phase2_data.py) describes, so that the pipeline can be tested and benchmarked without
+#the real exports.
+#
+#Volunteers are a mix of logged-in users and anonymous (IP address only) users. Activity per volunteer is heavy tailed: a
+#few volunteers make most of the classifications. Each volunteer turns up some time after their project's launch (most
+#of them soon after it) and stays for a heavy-tailed number of days. Classifications are made at local times of day
+#that follow a typical daily pattern, in the volunteer's own time zone.
+#
+#The quirks of the real exports that the pipeline has to deal with are reproduced:
+# * subject_data fields spelled in different cases for different subjects (e.g. Filename and filename)
+# * priority in place of #priority
+# * workflow versions that are not in WORKFLOW_KEEPERS, and classifications from before the launch or after STOPSTAMP
+# * classifications with negative durations
+# * anonymous users sharing IP addresses with logged-in volunteers
+# * subjects that are missing from the subjects export
+#
+#Each export is written a day at a time, so memory use depends upon the number of volunteers and subjects rather than
+#the number of classifications. The output is the same for the same arguments and --seed.
+
+import argparse
+import csv
+import importlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+#Columns of the exports, as Zooniverse gives them
+CLASSIFICATION_COLUMNS = ['classification_id', 'user_name', 'user_id', 'user_ip', 'workflow_id', 'workflow_name', 'workflow_version',
+                          'created_at', 'gold_standard', 'expert', 'metadata', 'annotations', 'subject_data', 'subject_ids']
+SUBJECT_COLUMNS = ['subject_id', 'project_id', 'workflow_id', 'subject_set_id', 'metadata', 'locations', 'classifications_count',
+                   'retired_at', 'retirement_reason', 'created_at', 'updated_at']
+
+#Rates of the quirks
+CASE_VARIANT_RATE = 0.3 #Subjects with their workflow-specific subject_data fields spelled in lower case
+PRIORITY_RATE = 0.05 #Subjects with priority in place of #priority
+OLD_VERSION_RATE = 0.05 #Fraction of each workflow's days (from the start) on a version that is not in WORKFLOW_KEEPERS
+NEGATIVE_DURATION_RATE = 0.001 #Classifications that finish before they start
+SHARED_IP_RATE = 0.2 #Anonymous users at the IP address of a logged-in volunteer
+UNLISTED_SUBJECT_RATE = 0.001 #Subjects missing from the subjects export
+RETIRED_RATE = 0.7 #Subjects that are retired at some point in the workflow's life
+
+#Shape of the activity
+CROSS_PROJECT_RATE = 0.1 #Volunteers who also take part in each project other than their main one
+LAUNCH_DECAY_DAYS = 30 #Volunteers arrive at a rate that decays exponentially from launch, with this time constant
+PRE_LAUNCH_DAYS = 14 #Days before launch that (beta testing) classifications can be made in
+PRE_LAUNCH_RATE = 0.02 #Volunteers who arrive before the launch
+POST_STOP_DAYS = 14 #Days after STOPSTAMP that classifications can be made in
+STAY_DAYS = 5 #Scale of the (heavy-tailed) number of days that volunteers stay for
+ANONYMOUS_ACTIVITY = 0.2 #Anonymous users are less active than logged-in volunteers, by this factor
+MEDIAN_DURATION_S = 30 #Median time to make a classification
+SUBJECTS_PER_SET = 500
+PAGES_PER_MEETING = 6 #Scarlets and Blues minute book pages per meeting date
+
+#Relative activity in each hour of the (local) day
+HOUR_WEIGHTS = np.array([2, 1, 1, 1, 1, 1, 2, 4, 6, 8, 9, 10, 10, 10, 10, 10, 10, 10, 11, 12, 13, 12, 8, 4], dtype = float)
+#Time zones of the volunteers, as Zooniverse's utc_offset (seconds to add to local time to get UTC), and their shares
+UTC_OFFSETS = np.array([0, -3600, 18000, 21600, 25200, 28800, -7200, -36000, -19800])
+UTC_OFFSET_WEIGHTS = np.array([45, 25, 8, 4, 2, 5, 5, 4, 2], dtype = float)
+USER_AGENTS = [
+  'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:91.0) Gecko/20100101 Firefox/91.0',
+  'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15',
+  'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/93.0.4577.63 Safari/537.36',
+  'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/93.0.4577.63 Safari/537.36',
+]
+NAMES = ['Smith', 'Jones', 'Brown', 'Taylor', 'Wilson', 'Davies', 'Evans', 'Thomas', 'Johnson', 'Roberts']
+PLACES = ['Tanzania', 'Kenya', 'Malawi', 'Cameroon', 'Gabon', 'Madagascar', 'Uganda', 'Zambia']
+SPECIES = ['Streptocarpus ionanthus', 'Streptocarpus rexii', 'Streptocarpus wendlandii', 'Saintpaulia teitensis', 'Epithema tenue']
+FORMATS = ['herbarium sheet', 'herbarium specimen']
+
+#Naive UTC datetime64 of a timestamp from a config
+def _stamp(s):
+  t = pd.Timestamp(s)
+  if t.tz is not None: t = t.tz_convert(None)
+  return t.to_datetime64()
+
+def _ms(timestamps):
+  return np.datetime_as_string(timestamps, unit = 'ms')
+
+def _hex(values):
+  return [f'{x:016x}' for x in values]
+
+#Value of subject data field for the ith subject of a pool (which is made up of subjects first_id onwards)
+#Values are made up to look right for the fields in the configs, and to be good enough for the config's location fixups.
+def _field_value(field, i, first_id):
+  k = field.lower()
+  if k == 'date': return str(np.datetime64('1890-01-06') + np.timedelta64(7 * (i // PAGES_PER_MEETING), 'D'))
+  if k == 'page': return i + 1
+  if k == 'catalogue': return f'PCOM 7/{433 + i // 50}'
+  if k == 'image': return f'PCOM_7_{433 + i // 50}_{i % 50 + 1:03d}.jpg'
+  if k == 'surnames starting with': return chr(ord('A') + i % 26)
+  if k == 'filename': return f'DSH-{first_id}-{i + 1:06d}.jpg'
+  if k == 'id': return str(first_id + i)
+  if k == 'botanist': return NAMES[i * 7 % len(NAMES)]
+  if k == 'group': return PLACES[i * 3 % len(PLACES)]
+  if k == 'format': return FORMATS[i % len(FORMATS)]
+  if k == 'species': return SPECIES[i * 5 % len(SPECIES)]
+  if k == 'barcode': return f'E{first_id + i:08d}'
+  return f'{field} {i + 1}'
+
+#The subjects shown in a set of workflows (of one project) that share the same subject data fields
+class SubjectPool(object):
+  def __init__(self, rng, fields, size, first_id, start, stop):
+    self.ids = np.arange(first_id, first_id + size)
+    self.set_ids = 100000 + first_id // SUBJECTS_PER_SET + np.arange(size) // SUBJECTS_PER_SET
+    lower = rng.random(size) < CASE_VARIANT_RATE
+    priority = np.where(rng.random(size) < PRIORITY_RATE, 'priority', '#priority')
+    #The subject data, other than whether the subject is retired, as the JSON for its fields
+    self.fields = []
+    for i in range(size):
+      data = {(f.lower() if lower[i] else f): _field_value(f, i, first_id) for f in fields}
+      data[priority[i]] = i + 1
+      self.fields.append(json.dumps(data)[1:-1])
+    span = (stop - start) / np.timedelta64(1, 's')
+    self.retired_at = np.where(rng.random(size) < RETIRED_RATE,
+                               start + (rng.random(size) * span * 1000).astype('timedelta64[ms]'),
+                               np.datetime64('NaT', 'ms'))
+    self.created_at = start - np.timedelta64(30, 'D')
+    self.locations = _hex(rng.integers(0, 2 ** 63, size))
+    self.unlisted = rng.random(size) < UNLISTED_SUBJECT_RATE
+    self.counts = {} #Classifications of each subject, per workflow
+
+#Everyone who classifies, whether logged in or anonymous
+class Population(object):
+  def __init__(self, rng, projects, volunteers, anonymous, alpha):
+    n = volunteers + anonymous
+    self.named = np.arange(n) < volunteers
+    self.user_id = 1000000 + np.cumsum(rng.integers(1, 50, n))
+    rng.shuffle(self.user_id)
+    self.ip = np.array(_hex(rng.integers(0, 2 ** 63, n)), dtype = object)
+    shared = ~self.named & (rng.random(n) < SHARED_IP_RATE)
+    if volunteers: self.ip[shared] = self.ip[rng.integers(0, volunteers, shared.sum())]
+    self.user_name = np.where(self.named, [f'volunteer{x}' for x in self.user_id], [f'not-logged-in-{x}' for x in self.ip])
+    self.user_id = np.where(self.named, self.user_id.astype(str), '')
+
+    #Classifications per active day, heavy tailed
+    self.activity = rng.pareto(alpha, n) + 1
+    self.activity[~self.named] *= ANONYMOUS_ACTIVITY
+    self.utc_offset = rng.choice(UTC_OFFSETS, n, p = UTC_OFFSET_WEIGHTS / UTC_OFFSET_WEIGHTS.sum())
+    #Days from launch to arrival, and days that they stay for
+    self.arrival = np.where(rng.random(n) < PRE_LAUNCH_RATE,
+                            -rng.integers(0, PRE_LAUNCH_DAYS + 1, n),
+                            np.floor(rng.exponential(LAUNCH_DECAY_DAYS, n))).astype(int)
+    self.stay = np.ceil(rng.pareto(1, n) * STAY_DAYS).astype(int)
+    self.user_agent = rng.integers(0, len(USER_AGENTS), n)
+
+    #Everyone has a main project, and might also take part in the others
+    main = rng.integers(0, len(projects), n)
+    self.members = {p: np.flatnonzero((main == i) | (rng.random(n) < CROSS_PROJECT_RATE)) for i, p in enumerate(projects)}
+
+#Versions of a workflow, in the order that they were live, with the days (from launch) that each came in on
+def versions(keepers, first_day, last_day):
+  major, minor = keepers[0].split('.')
+  old = f'{max(int(major) - 1, 0)}.{minor}'
+  if old in keepers: old = f'0.{minor}1'
+  live = np.linspace(first_day + (last_day - first_day) * OLD_VERSION_RATE, last_day + 1, len(keepers) + 1)[:-1]
+  return [old] + list(keepers), np.concatenate([[first_day], np.ceil(live)]).astype(int)
+
+#Write n classifications of workflow wid to f (a csv.writer), with ids from next_id onwards. Returns the next unused id.
+def write_classifications(f, rng, config, wid, n, population, members, pool, next_id):
+  launch = _stamp(config.WORKFLOW_STARTSTAMP[wid])
+  midnight = launch.astype('datetime64[D]')
+  first_day = -PRE_LAUNCH_DAYS
+  last_day = int((_stamp(config.STOPSTAMP).astype('datetime64[D]') - midnight) / np.timedelta64(1, 'D')) + POST_STOP_DAYS
+  version_names, version_days = versions(config.WORKFLOW_KEEPERS[wid], first_day, last_day)
+
+  #Each member's interest in this particular workflow varies, as does when they take part
+  activity = population.activity[members] * rng.lognormal(0, 1, len(members))
+  arrive = population.arrival[members]
+  leave = arrive + population.stay[members]
+
+  #Share out the classifications across the days, in proportion to the activity of those around on each day
+  days = np.arange(first_day, last_day + 1)
+  daily = np.zeros(len(days) + 1)
+  np.add.at(daily, np.clip(arrive - first_day, 0, len(days)), activity)
+  np.add.at(daily, np.clip(leave + 1 - first_day, 0, len(days)), -activity)
+  daily = np.maximum(np.cumsum(daily)[:-1], 0)
+  if daily.sum() == 0: daily[:] = 1 #Nobody around: spread them evenly, among everybody
+  counts = rng.multinomial(n, daily / daily.sum())
+  counts_by_subject = np.zeros(len(pool.ids), dtype = np.int64)
+  hours = HOUR_WEIGHTS / HOUR_WEIGHTS.sum()
+  workflow_name = config.WORKFLOW_NAMES[wid]
+  created_at = _ms(pool.created_at)
+
+  for day, count in zip(days, counts):
+    if count == 0: continue
+    around = (arrive <= day) & (leave >= day)
+    if not around.any(): around[:] = True
+    cdf = np.cumsum(activity[around])
+    who = members[around][np.minimum(np.searchsorted(cdf, rng.random(count) * cdf[-1], side = 'right'), around.sum() - 1)]
+
+    local = midnight + np.timedelta64(int(day), 'D') + (rng.choice(24, count, p = hours) * 3600000 + rng.integers(0, 3600000, count)).astype('timedelta64[ms]')
+    started = local + (population.utc_offset[who] * 1000).astype('timedelta64[ms]')
+    order = np.argsort(started, kind = 'stable')
+    who, started = who[order], started[order]
+    duration = rng.lognormal(np.log(MEDIAN_DURATION_S * 1000), 1, count).astype('timedelta64[ms]')
+    duration[rng.random(count) < NEGATIVE_DURATION_RATE] *= -1
+    finished = started + duration
+    created = np.maximum(started, finished) + rng.integers(100, 3000, count).astype('timedelta64[ms]')
+    subject = rng.integers(0, len(pool.ids), count)
+    np.add.at(counts_by_subject, subject, 1)
+    version = version_names[np.searchsorted(version_days, day, side = 'right') - 1]
+    retired = pool.retired_at[subject] <= started #False where NaT
+    session = _hex(rng.integers(0, 2 ** 63, count))
+    answer = rng.integers(0, 100000, count)
+
+    #Python values rather than numpy scalars from here on, as they are much quicker to format
+    columns = zip(population.user_name[who].tolist(), population.user_id[who].tolist(), population.ip[who].tolist(),
+                  population.utc_offset[who].tolist(), population.user_agent[who].tolist(), subject.tolist(), pool.ids[subject].tolist(),
+                  _ms(started), _ms(finished), np.datetime_as_string(created, unit = 's'), retired.tolist(), _ms(pool.retired_at[subject]), session, answer.tolist())
+    for i, (name, uid, ip, offset, agent, s, sid, st, fi, cr, ret, ret_at, sess, ans) in enumerate(columns):
+      metadata = (f'{{"source": "api", "session": "{sess}", "viewport": {{"width": 1280, "height": 720}}, "started_at": "{st}Z", '
+                  f'"user_agent": "{USER_AGENTS[agent]}", "utc_offset": "{offset}", "finished_at": "{fi}Z", '
+                  f'"live_project": true, "interventions": {{"opt_in": true, "messageShown": false}}, "user_language": "en", '
+                  f'"subject_dimensions": [{{"clientWidth": 800, "clientHeight": 1100, "naturalWidth": 3000, "naturalHeight": 4125}}], '
+                  f'"subject_selection_state": {{"retired": {"true" if ret else "false"}, "selected_at": "{st}Z", "already_seen": false, '
+                  f'"selection_state": "normal", "finished_workflow": false, "user_has_finished_workflow": false}}, "workflow_version": "{version}"}}')
+      if ret:
+        retired_json = (f'{{"id": {sid}{wid}, "workflow_id": {wid}, "classifications_count": 5, "created_at": "{created_at}Z", '
+                        f'"updated_at": "{ret_at}Z", "retired_at": "{ret_at}Z", "subject_id": {sid}, "retirement_reason": "classification_count"}}')
+      else:
+        retired_json = 'null'
+      f.writerow([next_id + i, name, uid, ip, wid, workflow_name, version, cr.replace('T', ' ') + ' UTC', '', '', metadata,
+                  f'[{{"task": "T0", "task_label": "Transcribe", "value": "{ans}"}}]', f'{{"{sid}": {{"retired": {retired_json}, {pool.fields[s]}}}}}', sid])
+    next_id += count
+
+  pool.counts[wid] = counts_by_subject
+  return next_id
+
+#Write the subjects export for a project, covering the workflows in pools (a dict of workflow id: SubjectPool)
+def write_subjects(f, project_id, pools):
+  for wid, pool in pools.items():
+    for i, sid in enumerate(pool.ids):
+      if pool.unlisted[i]: continue
+      retired = ~np.isnat(pool.retired_at[i])
+      f.writerow([sid, project_id, wid, pool.set_ids[i], '{' + pool.fields[i] + '}', f'{{"0": "https://panoptes-uploads.zooniverse.org/subject_location/{pool.locations[i]}.jpeg"}}',
+                  pool.counts[wid][i], f'{_ms(pool.retired_at[i])}Z' if retired else '', 'classification_count' if retired else '',
+                  f'{_ms(pool.created_at)}Z', f'{_ms(pool.retired_at[i] if retired else pool.created_at)}Z'])
+
+def _open(path, force):
+  return open(path, 'w' if force else 'x', newline = '')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Make synthetic Zooniverse exports for the workflows in a config')
+  parser.add_argument('workflows',
+                      nargs = '*',
+                      type = int,
+                      help = 'Workflows to make exports for (default: all of those in the config)')
+  parser.add_argument('--config',
+                      default = 'data',
+                      help = 'Python file to take the workflows, projects, subject data fields, versions and dates from')
+  parser.add_argument('--exports', '-e',
+                      default = 'synthetic_exports',
+                      help = 'Directory to write the exports to (pass this to pseudonymize.py as --exports)')
+  parser.add_argument('--classifications', '-n',
+                      type = int,
+                      default = 100000,
+                      help = 'Number of classifications, across all of the workflows')
+  parser.add_argument('--volunteers',
+                      type = int,
+                      default = 5000,
+                      help = 'Number of logged-in volunteers')
+  parser.add_argument('--anonymous',
+                      type = int,
+                      default = 1000,
+                      help = 'Number of anonymous (not logged in) users')
+  parser.add_argument('--subjects',
+                      type = int,
+                      default = 2000,
+                      help = 'Number of subjects for each set of workflows that share subjects')
+  parser.add_argument('--alpha',
+                      type = float,
+                      default = 1.2,
+                      help = 'Shape of the (Pareto) distribution of volunteer activity: the smaller, the heavier the tail')
+  parser.add_argument('--seed',
+                      type = int,
+                      help = 'Seed for the random number generator, to make the same exports again')
+  parser.add_argument('--force',
+                      action = argparse.BooleanOptionalAction,
+                      default = False,
+                      help = 'Overwrite existing exports')
+  args = parser.parse_args()
+  config = importlib.import_module(args.config)
+  if len(args.workflows) == 0:
+    args.workflows = list(config.WORKFLOW_NAMES.keys())
+  else:
+    assert set(args.workflows) <= set(config.WORKFLOW_NAMES.keys()) #if workflows are given on CLI, all given workflows must be given in the config
+
+  rng = np.random.default_rng(args.seed)
+  projects = {p: [w for w in wids if w in args.workflows] for p, wids in config.PROJECTS.items()}
+  projects = {p: wids for p, wids in projects.items() if len(wids)}
+  population = Population(rng, list(projects), args.volunteers, args.anonymous, args.alpha)
+
+  #Workflows of a project that have the same subject data fields show the same subjects
+  pools = {}
+  first_id = 10000000
+  for project, wids in projects.items():
+    shared = {}
+    for wid in wids:
+      fields = config.WORKFLOW_SUBJECT_KEEPERS[wid]
+      if not tuple(fields) in shared:
+        start = min(_stamp(config.WORKFLOW_STARTSTAMP[w]) for w in wids)
+        shared[tuple(fields)] = SubjectPool(rng, fields, args.subjects, first_id, start, _stamp(config.STOPSTAMP))
+        first_id += args.subjects
+      pools[wid] = shared[tuple(fields)]
+
+  #Some workflows are much busier than others
+  shares = rng.gamma(2, size = len(args.workflows))
+  sizes = rng.multinomial(args.classifications, shares / shares.sum())
+
+  os.makedirs(args.exports, exist_ok = True)
+  next_id = 300000000
+  for project, wids in projects.items():
+    for wid in wids:
+      n = sizes[args.workflows.index(wid)]
+      print(f'{wid} {config.WORKFLOW_NAMES[wid]}: {n} classifications')
+      with _open(f'{args.exports}/{config.WORKFLOW_NAMES[wid]}-classifications.csv', args.force) as f:
+        writer = csv.writer(f)
+        writer.writerow(CLASSIFICATION_COLUMNS)
+        next_id = write_classifications(writer, np.random.default_rng(None if args.seed is None else [args.seed, wid]), config,
+                                        wid, n, population, population.members[project], pools[wid], next_id)
+    print(f'Subjects for {project}')
+    with _open(f'{args.exports}/{config.SUBJECTS[project]}', args.force) as f:
+      writer = csv.writer(f)
+      writer.writerow(SUBJECT_COLUMNS)
+      write_subjects(writer, 20000 + list(config.PROJECTS).index(project), {wid: pools[wid] for wid in wids})
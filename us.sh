@@ -14,7 +14,7 @@ total=0
   echo 'Username ID Pseudonym Classifications'
   echo '-------- -- --------- ---------------'
   for key in "${!USER_ID[@]}"; do
-    pseudonym=`cat secrets/identities.json | jq --raw-output ".[\"${USER_ID[${key}]}\"]"`
+    pseudonym=`sqlite3 secrets/identities.sqlite "SELECT pseudonym FROM identities WHERE uid = '${USER_ID[${key}]}'"`
     classifications=`csvtool namedcol pseudonym secrets/graphs/${HASH}/prepared_classifications.csv | grep "^${pseudonym}$" | wc -l`
     total=$((total + classifications))
     echo "${key} (${USER_ID[${key}]}) (${pseudonym}): ${classifications}"
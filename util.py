@@ -1,4 +1,27 @@
 import git
+import collections
+import csv
+import hashlib
+import io
+import json
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+#Feather is columnar and quick to load, but needs pyarrow. Pickle will do if we do not have it.
+try:
+  import pyarrow
+  FRAME_FORMAT = 'feather'
+except ImportError:
+  FRAME_FORMAT = 'pickle'
 
 def path_norm(x):
   y = '_'.join(x.split())
@@ -19,13 +42,377 @@ def git_report_final_deps():
 def git_HEAD():
   return git.cmd.Git('.').rev_parse('HEAD')
 
-def git_condition():
-  g = git.cmd.Git('.')
-  fetch = g.fetch()
-  head = g.rev_parse('HEAD')
-  status = g.status('--porcelain', '-b')
-  return head + ' ' + status
-  
+#What this run is: the state of the code, how it was invoked and the config that it was given. Worked out once, when the
+#run starts (see start_run), and then read from RUN by everything that wants it, including processes forked later on.
+RUN = None
+
+class RunManifest(object):
+  def __init__(self, config, options):
+    g = git.cmd.Git('.')
+    #Fetch first, so that the status says how we stand against the remote. If we cannot, say so and carry on.
+    try:
+      self.fetch = {'ok': True, 'output': g.fetch()}
+    except git.GitCommandError as e:
+      self.fetch = {'ok': False, 'output': str(e)}
+      print(f'Warning: git fetch failed, so git status may be out of date:\n{e}', file = sys.stderr)
+    self.head = g.rev_parse('HEAD')
+    self.status = g.status('--porcelain', '-b')
+    self.condition = self.head + ' ' + self.status #The git state, as given in chart titles and READMEs
+    self.argv = list(sys.argv)
+    self.options = options
+    self.config = {'module': config.__name__, 'file': config.__file__, 'sha256': file_hash(config.__file__)}
+    self.started_at = pd.Timestamp.now(tz = 'UTC').isoformat()
+
+  def to_dict(self):
+    return {
+      'started_at': self.started_at,
+      'argv': self.argv,
+      'options': self.options,
+      'config': self.config,
+      'git': {'head': self.head, 'status': self.status, 'fetch': self.fetch},
+      'condition': self.condition,
+    }
+
+  def write(self, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(path, 'w') as f:
+      json.dump(self.to_dict(), f, indent = 2, default = str)
+
+#Start the run: work out its RunManifest and make it available as RUN
+#config is the config module (data or phase2_data) and options the parsed command line (an argparse.Namespace)
+def start_run(config, options):
+  global RUN
+  RUN = RunManifest(config, vars(options))
+  return RUN
+
+def file_hash(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()
+
+#Size, mtime and content hash of a file, for keying caches
+#If previous (an earlier result of this function for the same path) has the same size and mtime then
+#we trust its hash, so that checking an unchanged file does not mean reading the whole thing
+def file_signature(path, previous = None):
+  st = os.stat(path)
+  signature = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+  if previous and previous['size'] == signature['size'] and previous['mtime_ns'] == signature['mtime_ns']:
+    signature['sha256'] = previous['sha256']
+  else:
+    signature['sha256'] = file_hash(path)
+  return signature
+
+#Save and load dataframes in FRAME_FORMAT. The index is not kept, so reset_index/set_index as needed.
+def save_frame(df, path):
+  if FRAME_FORMAT == 'feather': df.reset_index(drop = True).to_feather(f'{path}.feather')
+  else: df.reset_index(drop = True).to_pickle(f'{path}.pkl')
+
+#Feather reads missing values in object columns back as None, where pandas would have NaN, so put the NaN back
+def load_frame(path):
+  if FRAME_FORMAT == 'feather':
+    df = pd.read_feather(f'{path}.feather')
+    for column in df.columns[df.dtypes == object]:
+      df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+  else: return pd.read_pickle(f'{path}.pkl')
+
+#Fingerprint of df's columns, types, index and values, for checking that a frame that is shared has not been changed
+#(Making the frame's arrays read-only would catch changes as they happen, but pandas refuses to work on read-only arrays
+#in all sorts of places, including ==)
+def frame_fingerprint(df):
+  return (list(df.columns), [str(t) for t in df.dtypes],
+          hashlib.sha256(pd.util.hash_pandas_object(df, index = True).to_numpy()).hexdigest())
+
+#Raise an exception if df no longer has the given fingerprint
+def check_unchanged(df, fingerprint, culprit):
+  if frame_fingerprint(df) != fingerprint:
+    raise Exception(f'{culprit} modified a shared frame')
+
+#Formats of the timestamps in Zooniverse exports and in the CSVs that we make from them, tried in turn. All are in UTC.
+#The first is for pandas' own strict (and very fast) ISO 8601 parser, which takes any ISO 8601 timestamp, with or without
+#a time zone. This covers the metadata and subject data timestamps, and our own outputs. pandas 2 asks for this parser
+#by name. Earlier versions use it for any ISO 8601 date format (but pandas 2 would hold '%Y-%m-%d' to dates alone).
+ISO8601_FORMAT = 'ISO8601' if int(pd.__version__.split('.')[0]) >= 2 else '%Y-%m-%d'
+TIMESTAMP_FORMATS = [
+  ISO8601_FORMAT,
+  '%Y-%m-%d %H:%M:%S UTC', #created_at
+]
+#Values per column to check against the general-purpose parser when verifying with 'sample'
+TIMESTAMP_SAMPLE_SIZE = 1000
+
+#General-purpose (and slow) timestamp parsing, as read_csv's parse_dates does it, converted to naive UTC
+def _slow_timestamps(values):
+  parsed = pd.to_datetime(pd.Series(values, dtype = object))
+  if parsed.dt.tz is not None: parsed = parsed.dt.tz_convert(None)
+  return parsed.to_numpy()
+
+#Parse a column of timestamp strings to naive UTC datetime64[ns], trying each of TIMESTAMP_FORMATS in turn
+#Anything that is not in one of those formats goes through the general-purpose parser, so the result is always the same as
+#that parser's. verify ('full', 'sample' or 'off') checks this by parsing all, a sample or none of the values both ways.
+def parse_timestamps(s, verify = 'off'):
+  values = s.to_numpy(dtype = object)
+  result = np.full(len(values), np.datetime64('NaT'), dtype = 'datetime64[ns]')
+  pending = pd.notna(values)
+  for fmt in TIMESTAMP_FORMATS:
+    if not pending.any(): break
+    parsed = pd.to_datetime(values[pending], format = fmt, errors = 'coerce', utc = True).tz_convert(None).to_numpy()
+    ok = ~np.isnat(parsed)
+    positions = np.flatnonzero(pending)[ok]
+    result[positions] = parsed[ok]
+    pending[positions] = False
+  if pending.any():
+    print(f'Parsing {pending.sum()} timestamp(s) in {s.name} with the general-purpose parser, e.g. "{values[pending][0]}"', file = sys.stderr)
+    result[pending] = _slow_timestamps(values[pending])
+
+  if verify != 'off':
+    positions = np.flatnonzero(pd.notna(values))
+    if verify == 'sample' and len(positions) > TIMESTAMP_SAMPLE_SIZE:
+      positions = np.sort(np.random.default_rng().choice(positions, TIMESTAMP_SAMPLE_SIZE, replace = False))
+    expected = _slow_timestamps(values[positions])
+    actual = result[positions]
+    bad = (expected != actual) & ~(np.isnat(expected) & np.isnat(actual))
+    if bad.any():
+      raise Exception(f'Timestamp parsing mismatch in {s.name}:\n' +
+                      '\n'.join(f'"{v}": {a} but expected {e}' for v, a, e in zip(values[positions][bad], actual[bad], expected[bad])))
+  return pd.Series(result, index = s.index, name = s.name)
+
+#Sorted, de-duplicated int64 array of ids, for quick membership tests with index_contains
+def id_index(ids):
+  return np.unique(np.asarray(ids, dtype = np.int64))
+
+#Boolean array: whether each of values is in index (as made by id_index), by binary search
+def index_contains(index, values):
+  values = np.asarray(values, dtype = np.int64)
+  if len(index) == 0: return np.zeros(len(values), dtype = bool)
+  positions = np.minimum(np.searchsorted(index, values), len(index) - 1)
+  return index[positions] == values
+
+#Build up a CSV from a sequence of dataframes without holding them all in memory
+#The columns are the union of the columns of all of the dataframes, in order of appearance, and are left empty in rows
+#from dataframes that do not have them. The columns in group (if any) all go in together, in the order given, where the
+#first of them appears: so if the dataframes are bits of a frame that had the group's columns added before some others
+#(e.g. the subj.* columns of all workflows, before pseudonym and md.*), the columns come out in the order that frame's would.
+#With drop_empty, columns that are empty in every row are left out, as with dropna(axis = 'columns', how = 'all').
+#Each dataframe is written out as it arrives, into a segment file in tmpdir. close() stitches the segments together.
+class ChunkedCSV(object):
+  def __init__(self, tmpdir, drop_empty = False, group = (), **to_csv_kwargs):
+    self.tmpdir = tmpdir
+    self.drop_empty = drop_empty
+    self.group = list(group)
+    self.to_csv_kwargs = to_csv_kwargs
+    self.segments = [] #(path, columns) pairs
+    self.columns = {} #column name: whether it has any values. Dicts keep insertion order, so this also gives column order.
+  def write(self, df):
+    columns = list(df.columns)
+    header = len(self.segments) == 0 or self.segments[-1][1] != columns
+    if header:
+      fd, path = tempfile.mkstemp(suffix = '.csv', dir = self.tmpdir)
+      os.close(fd)
+      self.segments.append((path, columns))
+    for column in columns:
+      if column in self.group and not column in self.columns:
+        for g in self.group: self.columns.setdefault(g, False)
+      self.columns[column] = self.columns.get(column, False) or bool(df[column].notna().any())
+    df.to_csv(self.segments[-1][0], index = False, mode = 'a', header = header, **self.to_csv_kwargs)
+  #Write the stitched-together CSV to a binary file object. Can be called more than once.
+  def copy_to(self, f):
+    columns = [k for k, v in self.columns.items() if v or not self.drop_empty]
+    text = io.TextIOWrapper(f, encoding = 'utf-8', newline = '')
+    writer = csv.writer(text, lineterminator = os.linesep) #Same dialect as to_csv's defaults
+    writer.writerow(columns)
+    for segment, segment_columns in self.segments:
+      positions = [segment_columns.index(c) if c in segment_columns else None for c in columns]
+      with open(segment, newline = '') as s:
+        reader = csv.reader(s)
+        next(reader)
+        for row in reader:
+          writer.writerow(['' if p is None else row[p] for p in positions])
+    text.flush()
+    text.detach()
+  def close(self, path):
+    with open(path, 'wb') as f:
+      self.copy_to(f)
+    for segment, _ in self.segments:
+      os.unlink(segment)
+    self.segments = []
+
+#Fixed timestamp and permissions for archive members, so that archiving the same data always gives the same bytes
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0) #Earliest date that zip can represent
+ARCHIVE_MTIME = 315532800 #The same, as a Unix timestamp
+
+#A member source that copies in the file at path
+def file_source(path):
+  def source(f):
+    with open(path, 'rb') as src:
+      shutil.copyfileobj(src, f)
+  return source
+
+#A member source that writes df out with df.to_csv(**to_csv_kwargs), straight into the member
+def csv_source(df, **to_csv_kwargs):
+  def source(f):
+    text = io.TextIOWrapper(f, encoding = 'utf-8', newline = '')
+    df.to_csv(text, **to_csv_kwargs)
+    text.flush()
+    text.detach() #Leave f open for the archive writer
+  return source
+
+#A member source that copies member out of the zip file at archive, followed by whatever the source tail writes, if
+#given (e.g. rows to append to a CSV)
+def zip_member_source(archive, member, tail = None):
+  def source(f):
+    with zipfile.ZipFile(archive) as zf, zf.open(member) as src:
+      shutil.copyfileobj(src, f)
+    if tail: tail(f)
+  return source
+
+#write_archives renders each callable source once, into a file, and the archive writers copy from there
+class _Rendered(object):
+  def __init__(self, path):
+    self.path = path
+    self.size = os.path.getsize(path)
+
+def _source_size(source):
+  return len(source) if isinstance(source, bytes) else source.size
+
+def _write_source(source, f):
+  if isinstance(source, bytes): f.write(source)
+  else:
+    with open(source.path, 'rb') as src:
+      shutil.copyfileobj(src, f)
+
+def _member_dirs(members):
+  dirs = []
+  for arcname, _ in members:
+    parts = arcname.split('/')[:-1]
+    for i in range(1, len(parts) + 1):
+      d = '/'.join(parts[:i])
+      if not d in dirs: dirs.append(d)
+  return dirs
+
+def _write_zip(path, members):
+  with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+    for d in _member_dirs(members):
+      info = zipfile.ZipInfo(d + '/', ARCHIVE_DATE_TIME)
+      info.create_system = 3
+      info.external_attr = (0o40755 << 16) | 0x10
+      zf.writestr(info, b'')
+    for arcname, source in members:
+      info = zipfile.ZipInfo(arcname, ARCHIVE_DATE_TIME)
+      info.create_system = 3
+      info.external_attr = 0o100644 << 16
+      info.compress_type = zipfile.ZIP_DEFLATED
+      with zf.open(info, 'w', force_zip64 = True) as f:
+        _write_source(source, f)
+
+def _tar_header(name, size = 0, directory = False):
+  info = tarfile.TarInfo(name)
+  info.mtime = ARCHIVE_MTIME
+  info.uid = info.gid = 0
+  info.uname = info.gname = ''
+  if directory:
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+  else:
+    info.size = size
+    info.mode = 0o644
+  return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+#Write a tar stream to f by hand, so that members can be streamed in from their sources rather than from files
+def _write_tar(f, members):
+  offset = 0
+  def put(b):
+    nonlocal offset
+    f.write(b)
+    offset += len(b)
+  for d in _member_dirs(members):
+    put(_tar_header(f'./{d}', directory = True))
+  for arcname, source in members:
+    size = _source_size(source)
+    put(_tar_header(f'./{arcname}', size))
+    _write_source(source, f)
+    offset += size
+    if size % tarfile.BLOCKSIZE:
+      put(tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+  put(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+  if offset % tarfile.RECORDSIZE:
+    put(tarfile.NUL * (tarfile.RECORDSIZE - offset % tarfile.RECORDSIZE))
+
+#Size of the blocks that .tar.xz archives are compressed in, each on its own thread
+#Fixed, rather than depending upon the number of cores, so that the archive is the same wherever it is made
+XZ_BLOCK_SIZE = 8 * 1024 * 1024
+
+#File object that compresses what is written to it in XZ_BLOCK_SIZE blocks, each into its own .xz stream, on a pool of
+#threads, and writes the streams to out in order (one .xz stream after another is itself a valid .xz file)
+class _BlockXZWriter(object):
+  def __init__(self, out, threads):
+    self.out = out
+    self.threads = threads
+    self.pool = ThreadPoolExecutor(threads)
+    self.pending = collections.deque()
+    self.buffer = bytearray()
+
+  def write(self, b):
+    self.buffer += b
+    while len(self.buffer) >= XZ_BLOCK_SIZE:
+      self._compress(bytes(self.buffer[:XZ_BLOCK_SIZE]))
+      del self.buffer[:XZ_BLOCK_SIZE]
+
+  def _compress(self, block):
+    self.pending.append(self.pool.submit(lzma.compress, block))
+    while len(self.pending) > self.threads: #Keep no more blocks in memory than we can be compressing
+      self.out.write(self.pending.popleft().result())
+
+  #Compress and write out whatever is left
+  def close(self):
+    if len(self.buffer): self._compress(bytes(self.buffer))
+    while len(self.pending): self.out.write(self.pending.popleft().result())
+
+#xz is forced into multi-threaded mode (even with one thread, which it would otherwise compress in single-threaded mode,
+#giving different bytes), and blocks are a fixed size, so that the bytes do not depend upon the number of cores.
+#Without xz, lzma compresses blocks of the same size in parallel. That does not give the same bytes as xz (each block is
+#a stream of its own), but it too gives the same bytes wherever it is run.
+def _write_tar_xz(path, members):
+  threads = os.cpu_count() or 1
+  with open(path, 'wb') as out:
+    if shutil.which('xz'):
+      xz = subprocess.Popen(['xz', f'--threads=+{threads}', f'--block-size={XZ_BLOCK_SIZE}', '--stdout'], stdin = subprocess.PIPE, stdout = out)
+      try:
+        _write_tar(xz.stdin, members)
+      finally:
+        xz.stdin.close()
+        if xz.wait() != 0: raise Exception(f'xz failed while writing {path}')
+    else:
+      f = _BlockXZWriter(out, threads)
+      try:
+        _write_tar(f, members)
+        f.close()
+      finally:
+        f.pool.shutdown(cancel_futures = True)
+
+#Write base_name.zip and base_name.tar.xz, concurrently, containing members
+#members is a list of (arcname, source) pairs, where source is either bytes or a callable that writes the member's content
+#to the binary file object that it is passed. Each callable is called once, into a temporary file alongside the archives,
+#which both archives are then written from.
+#Output is reproducible: fixed member order, timestamps and permissions.
+def write_archives(base_name, members):
+  writers = {'zip': _write_zip, 'tar.xz': _write_tar_xz}
+  with tempfile.TemporaryDirectory(dir = os.path.dirname(base_name) or '.') as tmpdir:
+    rendered = []
+    for i, (arcname, source) in enumerate(members):
+      if not isinstance(source, bytes):
+        path = f'{tmpdir}/{i}'
+        with open(path, 'wb') as f:
+          source(f)
+        source = _Rendered(path)
+      rendered.append((arcname, source))
+    with ThreadPoolExecutor(len(writers)) as pool:
+      futures = [pool.submit(writer, f'{base_name}.{ext}.tmp', rendered) for ext, writer in writers.items()]
+      for future in futures: future.result() #Propagate any exceptions
+  for ext in writers:
+    os.replace(f'{base_name}.{ext}.tmp', f'{base_name}.{ext}')
+
 #https://stackoverflow.com/a/14906787
 import sys
 class Logger(object):